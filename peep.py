@@ -27,26 +27,67 @@ try:
 except NameError:
     xrange = range
 from base64 import urlsafe_b64encode, urlsafe_b64decode
-from binascii import hexlify
+from binascii import hexlify, unhexlify, Error as BinasciiError
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
 import cgi
 from collections import defaultdict
+from contextlib import contextmanager
+import csv
 from functools import wraps
+from glob import glob
 from hashlib import sha256
 from itertools import chain, islice
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import ThreadPool
+import errno
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+from fnmatch import fnmatchcase
+import io
+import json
 import mimetypes
-from optparse import OptionParser
-from os.path import join, basename, splitext, isdir
+import mmap
+from optparse import OptionParser, Values
+import os
+from os.path import (join, basename, splitext, isdir, dirname, expanduser, exists,
+                     normpath, sep)
 from pickle import dumps, loads
+import posixpath
+import py_compile
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 import re
+import socket
+from stat import S_ISLNK
+from subprocess import PIPE, Popen, STDOUT
+try:
+    from SocketServer import StreamRequestHandler
+    import SocketServer as socketserver
+except ImportError:
+    from socketserver import StreamRequestHandler
+    import socketserver
 import sys
-from shutil import rmtree, copy
+import tarfile
+from shutil import rmtree, copy, copymode
 from sys import argv, exit
+import tempfile
 from tempfile import mkdtemp
+from threading import Lock, Semaphore, Thread
+from time import sleep, time
 import traceback
 try:
-    from urllib2 import build_opener, HTTPHandler, HTTPSHandler, HTTPError
+    from urllib2 import build_opener, HTTPHandler, HTTPSHandler, HTTPError, Request
+    from urllib import url2pathname
 except ImportError:
-    from urllib.request import build_opener, HTTPHandler, HTTPSHandler
+    from urllib.request import (build_opener, HTTPHandler, HTTPSHandler, Request,
+                                url2pathname)
     from urllib.error import HTTPError
 try:
     from urlparse import urlparse
@@ -54,7 +95,8 @@ except ImportError:
     from urllib.parse import urlparse  # 3.4
 # TODO: Probably use six to make urllib stuff work across 2/3.
 
-from pkg_resources import require, VersionConflict, DistributionNotFound, safe_name
+from pkg_resources import (require, VersionConflict, DistributionNotFound, safe_name,
+                           Requirement, WorkingSet, parse_version)
 
 # We don't admit our dependency on pip in setup.py, lest a naive user simply
 # say `pip install peep.tar.gz` and thus pull down an untrusted copy of pip
@@ -72,51 +114,63 @@ def activate(specifier):
         raise RuntimeError('The installed version of pip is too old; peep '
                            'requires ' + specifier)
 
-# Before 0.6.2, the log module wasn't there, so some
-# of our monkeypatching fails. It probably wouldn't be
-# much work to support even earlier, though.
-activate('pip>=0.6.2')
+__version__ = 3, 1, 2
 
-import pip
-from pip.commands.install import InstallCommand
-try:
-    from pip.download import url_to_path  # 1.5.6
-except ImportError:
-    try:
-        from pip.util import url_to_path  # 0.7.0
-    except ImportError:
-        from pip.util import url_to_filename as url_to_path  # 0.6.2
-from pip.exceptions import InstallationError
-from pip.index import PackageFinder, Link
-try:
-    from pip.log import logger
-except ImportError:
-    from pip import logger  # 6.0
-from pip.req import parse_requirements
-try:
-    from pip.utils.ui import DownloadProgressBar, DownloadProgressSpinner
-except ImportError:
-    class NullProgressBar(object):
-        def __init__(self, *args, **kwargs):
-            pass
+# pip and the bits of it we use are imported by load_pip(), only once a
+# command actually needs them. That keeps commands which never touch pip--like
+# talking to a ``peep serve`` daemon--from paying to import it.
+pip = None
 
-        def iter(self, ret, *args, **kwargs):
-            return ret
 
-    DownloadProgressBar = DownloadProgressSpinner = NullProgressBar
+def load_pip():
+    """Make sure a new-enough pip is imported, and pull in the parts of it we
+    use. Raise a RuntimeError if pip is too old.
 
-__version__ = 3, 1, 2
+    This is cheap to call again once it has succeeded.
 
-try:
-    from pip.index import FormatControl  # noqa
-    FORMAT_CONTROL_ARG = 'format_control'
+    """
+    global pip, InstallCommand, url_to_path, InstallationError, PackageFinder, \
+        Link, logger, parse_requirements, FORMAT_CONTROL_ARG, \
+        PIP_COUNTS_COMMENTS, vcs
+    if pip is not None:
+        return
+
+    # Before 0.6.2, the log module wasn't there, so some
+    # of our monkeypatching fails. It probably wouldn't be
+    # much work to support even earlier, though.
+    activate('pip>=0.6.2')
+
+    from pip.commands.install import InstallCommand
+    try:
+        from pip.download import url_to_path  # 1.5.6
+    except ImportError:
+        try:
+            from pip.util import url_to_path  # 0.7.0
+        except ImportError:
+            from pip.util import url_to_filename as url_to_path  # 0.6.2
+    from pip.exceptions import InstallationError
+    from pip.index import PackageFinder, Link
+    try:
+        from pip.log import logger
+    except ImportError:
+        from pip import logger  # 6.0
+    from pip.req import parse_requirements
+    from pip.vcs import vcs
 
-    # The line-numbering bug will be fixed in pip 8. All 7.x releases had it.
-    PIP_MAJOR_VERSION = int(pip.__version__.split('.')[0])
-    PIP_COUNTS_COMMENTS = PIP_MAJOR_VERSION >= 8
-except ImportError:
-    FORMAT_CONTROL_ARG = 'use_wheel'  # pre-7
-    PIP_COUNTS_COMMENTS = True
+    try:
+        from pip.index import FormatControl  # noqa
+        FORMAT_CONTROL_ARG = 'format_control'
+
+        # The line-numbering bug will be fixed in pip 8. All 7.x releases had it.
+        PIP_MAJOR_VERSION = int(__import__('pip').__version__.split('.')[0])
+        PIP_COUNTS_COMMENTS = PIP_MAJOR_VERSION >= 8
+    except ImportError:
+        FORMAT_CONTROL_ARG = 'use_wheel'  # pre-7
+        PIP_COUNTS_COMMENTS = True
+
+    # Assign this last so a failed import doesn't leave us half-loaded but
+    # believing we're done:
+    pip = __import__('pip')
 
 
 ITS_FINE_ITS_FINE = 0
@@ -141,6 +195,10 @@ class UnsupportedRequirementError(Exception):
     """An unsupported line was encountered in a requirements file."""
 
 
+class OptionError(Exception):
+    """A peep-specific command-line option was used wrongly."""
+
+
 class DownloadError(Exception):
     def __init__(self, link, exc):
         self.link = link
@@ -171,12 +229,15 @@ def path_and_line(req):
     return path, int(line)
 
 
-def hashes_above(path, line_number):
-    """Yield hashes from contiguous comment lines before line ``line_number``.
+def comments_above(path, line_number, comment_re, group):
+    """Return the values of the ``comment_re`` comments in the contiguous
+    comment lines before line ``line_number``.
+
+    :arg group: The name of the regex group holding the value
 
     """
-    def hash_lists(path):
-        """Yield lists of hashes appearing between non-comment lines.
+    def value_lists(path):
+        """Yield lists of values appearing between non-comment lines.
 
         The lists will be in order of appearance and, for each non-empty
         list, their place in the results will coincide with that of the
@@ -184,22 +245,334 @@ def hashes_above(path, line_number):
         (which changed in pip 7.0 to not count comments).
 
         """
-        hashes = []
+        values = []
         with open(path) as file:
             for lineno, line in enumerate(file, 1):
-                match = HASH_COMMENT_RE.match(line)
-                if match:  # Accumulate this hash.
-                    hashes.append(match.groupdict()['hash'])
+                match = comment_re.match(line)
+                if match:  # Accumulate this value.
+                    values.append(match.groupdict()[group])
                 if not IGNORED_LINE_RE.match(line):
-                    yield hashes  # Report hashes seen so far.
-                    hashes = []
+                    yield values  # Report values seen so far.
+                    values = []
                 elif PIP_COUNTS_COMMENTS:
-                    # Comment: count as normal req but have no hashes.
+                    # Comment: count as normal req but have no values.
                     yield []
 
-    return next(islice(hash_lists(path), line_number - 1, None))
+    return next(islice(value_lists(path), line_number - 1, None))
+
+
+def hashes_above(path, line_number):
+    """Return hashes from contiguous comment lines before line
+    ``line_number`` and from pip 8 ``--hash`` options on the line itself, all
+    in peep's format."""
+    return (comments_above(path, line_number, HASH_COMMENT_RE, 'hash') +
+            option_hashes(requirement_text(path, line_number))[0])
+
+
+def requirement_text(path, line_number):
+    """Return the text of the requirement pip calls line ``line_number`` of a
+    requirements file, joined across backslash continuations, without any
+    trailing comment."""
+    with io.open(path, encoding='utf-8') as file:
+        lines = file.readlines()
+    spanned = []
+    for line in lines[line_index(lines, line_number):]:
+        spanned.append(line)
+        if not line.rstrip('\r\n').endswith('\\'):
+            break
+    return joined_requirement(spanned)[0]
+
+
+def option_hashes(text):
+    """Return the hashes from the pip 8 ``--hash=sha256:<hex>`` options in a
+    requirement's text, turned into peep's format so they compare directly
+    against the archives' hashes, and a list of the ``--hash`` values which
+    aren't sha256 hex digests and so can't be checked."""
+    hashes, bad = [], []
+    for match in HASH_OPTION_RE.finditer(text):
+        algorithm, digest = match.group('algorithm', 'digest')
+        try:
+            if algorithm != 'sha256' or len(digest) != 64:
+                raise ValueError
+            hashes.append(urlsafe_b64encode(unhexlify(digest.encode('ascii')))
+                          .decode('ascii').rstrip('='))
+        except (ValueError, TypeError, BinasciiError):
+            bad.append('%s:%s' % (algorithm, digest))
+    return hashes, bad
+
+
+def tree_hashes_above(path, line_number):
+    """Return tree hashes, for directory and VCS requirements, from contiguous
+    comment lines before line ``line_number``."""
+    return comments_above(path, line_number, TREE_HASH_COMMENT_RE, 'hash')
+
+
+def size_above(path, line_number):
+    """Return the size hinted by a ``# size:`` comment in the contiguous
+    comment lines before line ``line_number``, or None if there isn't one."""
+    sizes = comments_above(path, line_number, SIZE_COMMENT_RE, 'size')
+    return parse_size(sizes[-1]) if sizes else None
+
+
+def parse_size(text):
+    """Return the number of bytes meant by a size like "4096", "600K", or
+    "1.5G". Raise ValueError if it doesn't look like one."""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*$', text, re.I)
+    if not match:
+        raise ValueError('"%s" is not a size.' % text)
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' KMG'.index(unit.upper() or ' '))
+
+
+def format_size(size):
+    """Return a short, human-readable form of a number of bytes, the
+    reverse of ``parse_size()``: for example, "600K" or "1.5G"."""
+    for unit in 'KMG':
+        size /= 1024.0
+        if size < 1024 or unit == 'G':
+            return ('%.1f%s' if size < 10 else '%.0f%s') % (size, unit)
+
+
+def requirement_chunks(lines):
+    """Walk the lines of a requirements file in one pass, without pip,
+    yielding a tuple for each requirement or option line: (the comment and
+    blank lines above it, the lines it spans).
+
+    A line ending in a backslash continues onto the next. Comments and blank
+    lines after the last requirement come out with an empty list of lines.
+
+    """
+    comments = []
+    spanned = []
+    for line in lines:
+        if spanned or not IGNORED_LINE_RE.match(line):
+            spanned.append(line)
+            if not line.rstrip('\r\n').endswith('\\'):
+                yield comments, spanned
+                comments, spanned = [], []
+        else:
+            comments.append(line)
+    if comments or spanned:
+        yield comments, spanned
+
+
+def joined_requirement(spanned):
+    """Return the text of a requirement spread across lines by backslash
+    continuations, without any trailing comment, and the comment."""
+    text = ' '.join(line.rstrip('\r\n').rstrip('\\').strip() for line in spanned)
+    match = re.search(r'(^|\s)+#.*$', text)
+    if match:
+        return text[:match.start()], text[match.start():].strip()
+    return text, ''
+
+
+def included_path(path, text):
+    """If a requirement line's text is a ``-r`` include, return the path of
+    the included file, resolved like pip does. Otherwise, return None."""
+    match = re.match(r'(-r|--requirement)(?:\s+|=)(.*)$', text)
+    if not match:
+        return None
+    included = match.group(2).strip()
+    return included if urlparse(included).scheme else join(dirname(path), included)
+
+
+def replace_file(path, lines):
+    """Replace a file's contents with some lines, atomically, so an
+    interruption never leaves a half-written file. Keep its permissions.
+
+    :arg lines: An iterable of lines, which is consumed as it's written
+
+    """
+    temp_path = '%s.%s' % (path, os.getpid())
+    try:
+        with io.open(temp_path, 'w', encoding='utf-8', newline='') as file:
+            file.writelines(lines)
+        copymode(path, temp_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    os.rename(temp_path, path)
+
+
+class Metrics(object):
+    """Counters and histograms of where peep's time and bytes go, for fleet
+    monitoring
+
+    Nothing is recorded until ``configure()`` is given somewhere to send
+    them, so hot paths can record unconditionally at the cost of one
+    attribute check. ``export()`` then writes them to a Prometheus
+    textfile-collector file, adding to the totals already there, and/or
+    sends them to a statsd daemon over UDP.
+
+    """
+    # Upper bounds, in seconds, of the Prometheus histogram buckets
+    BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = Lock()
+        self._textfile = self._statsd = None
+        self._counters = defaultdict(float)
+        self._observations = defaultdict(list)
+
+    def configure(self, options):
+        """Start recording if ``--metrics-file`` or ``--statsd`` was given.
+
+        :arg options: peep's own options, as from ``peep_options()``
 
+        """
+        self._textfile = options.metrics_file
+        if options.statsd:
+            host, _, port = options.statsd.rpartition(':')
+            if not host:
+                host, port = port, '8125'
+            try:
+                self._statsd = host, int(port)
+            except ValueError:
+                raise OptionError('--statsd takes the form host:port.')
+        self.enabled = bool(self._textfile or self._statsd)
+
+    def count(self, name, value=1, **labels):
+        """Add ``value`` to a counter."""
+        if self.enabled:
+            with self._lock:
+                self._counters[name, tuple(sorted(labels.items()))] += value
+
+    def observe(self, name, value, **labels):
+        """Record a number of seconds in a histogram."""
+        if self.enabled:
+            with self._lock:
+                self._observations[name, tuple(sorted(labels.items()))].append(value)
+
+    def export(self):
+        """Send what's been recorded wherever it's configured to go, and
+        start afresh.
+
+        Failing to report is no reason to fail an install, so problems are
+        just mentioned on stderr.
 
+        """
+        if not self.enabled:
+            return
+        try:
+            if self._textfile:
+                self._write_textfile(self._textfile)
+            if self._statsd:
+                self._send_statsd(*self._statsd)
+        except (IOError, OSError, socket.error) as exc:
+            sys.stderr.write("Couldn't export metrics: %s\n" % exc)
+        self.__init__()
+
+    def _samples(self):
+        """Return a map of family name -> (Prometheus type, map of sample
+        text (name and labels) -> value)."""
+        def escaped(value):
+            return (str(value).replace('\\', '\\\\')
+                              .replace('"', '\\"')
+                              .replace('\n', '\\n'))
+
+        def sample(name, labels):
+            if not labels:
+                return name
+            return '%s{%s}' % (name, ','.join('%s="%s"' % (key, escaped(value))
+                                              for key, value in labels))
+
+        families = {}
+        for (name, labels), total in self._counters.items():
+            families.setdefault(name, ('counter', {}))[1][sample(name, labels)] = total
+        for (name, labels), values in self._observations.items():
+            samples = families.setdefault(name, ('histogram', {}))[1]
+            for bound in self.BUCKETS:
+                samples[sample(name + '_bucket', labels + (('le', '%g' % bound),))] = \
+                    len([v for v in values if v <= bound])
+            samples[sample(name + '_bucket', labels + (('le', '+Inf'),))] = len(values)
+            samples[sample(name + '_sum', labels)] = sum(values)
+            samples[sample(name + '_count', labels)] = len(values)
+        return families
+
+    def _write_textfile(self, path):
+        """Add my samples to those in a Prometheus textfile, replacing it
+        atomically so the collector never reads half of one."""
+        families = self._samples()
+        try:
+            with open(path) as file:
+                family = None
+                for line in file:
+                    if line.startswith('# TYPE '):
+                        _, _, family, type = line.split()
+                        families.setdefault(family, (type, {}))
+                    elif line.strip() and not line.startswith('#') and family:
+                        key, value = line.rsplit(None, 1)
+                        samples = families[family][1]
+                        samples[key] = samples.get(key, 0) + float(value)
+        except (IOError, OSError, ValueError):
+            pass  # Start fresh rather than choke on a missing or odd file.
+
+        def bucket_order(key):
+            le = re.search(r'le="([^"]*)"', key)
+            return key[:le.start()] if le else key, float(le.group(1)) if le else 0
+
+        def number(value):
+            return '%d' % value if value == int(value) else repr(value)
+
+        temp_path = '%s.%s' % (path, os.getpid())
+        with open(temp_path, 'w') as file:
+            for family in sorted(families):
+                type, samples = families[family]
+                file.write('# TYPE %s %s\n' % (family, type))
+                for key in sorted(samples, key=bucket_order):
+                    file.write('%s %s\n' % (key, number(samples[key])))
+        os.rename(temp_path, path)
+
+    def _send_statsd(self, host, port):
+        """Send my counters and timings to a statsd daemon, with label values
+        folded into the metric names, as plain statsd has no labels."""
+        def name(name, labels):
+            return '.'.join([name] + [re.sub(r'[^A-Za-z0-9_-]', '_', str(value))
+                                      for _, value in labels])
+
+        lines = ['%s:%s|c' % (name(*key), int(total))
+                 for key, total in self._counters.items()]
+        lines.extend('%s:%d|ms' % (name(*key), value * 1000)
+                     for key, values in self._observations.items()
+                     for value in values)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            packet = []
+            for line in lines:
+                # Keep packets small enough not to be fragmented.
+                if packet and len('\n'.join(packet + [line])) > 512:
+                    sock.sendto('\n'.join(packet).encode('utf-8'), (host, port))
+                    packet = []
+                packet.append(line)
+            if packet:
+                sock.sendto('\n'.join(packet).encode('utf-8'), (host, port))
+        finally:
+            sock.close()
+
+
+# What this run of peep has been up to, for monitoring
+METRICS = Metrics()
+
+
+def measured(name):
+    """Record how long each call to a function takes in the ``name``
+    histogram, when metrics are enabled."""
+    def decorator(func):
+        @wraps(func)
+        def measurer(*args, **kwargs):
+            if not METRICS.enabled:
+                return func(*args, **kwargs)
+            start = time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                METRICS.observe(name, time() - start)
+        return measurer
+    return decorator
+
+
+@measured('peep_pip_seconds')
 def run_pip(initial_args):
     """Delegate to pip the given args (starting with the subcommand), and raise
     ``PipException`` if something goes wrong."""
@@ -214,18 +587,364 @@ def run_pip(initial_args):
         raise PipException(status_code)
 
 
-def hash_of_file(path):
-    """Return the hash of a downloaded file."""
+@measured('peep_pip_seconds')
+def run_pip_in(python, initial_args):
+    """Delegate to the pip of another Python interpreter the given args
+    (starting with the subcommand), print what it says, and raise
+    ``PipException`` if something goes wrong."""
+    process = Popen([python, '-m', 'pip'] + initial_args, stdout=PIPE, stderr=STDOUT)
+    output, _ = process.communicate()
+    # Print it all at once so concurrent installs don't interleave:
+    print('[%s]\n%s' % (python, output.decode('utf-8', 'replace')))
+    if process.returncode:
+        raise PipException(process.returncode)
+
+
+@measured('peep_hash_seconds')
+def hash_of_file(path, rate_limit=None):
+    """Return the hash of a downloaded file.
+
+    :arg rate_limit: A RateLimit to hold the reading to, if any
+
+    """
     with open(path, 'rb') as archive:
         sha = sha256()
+        size = 0
         while True:
             data = archive.read(2 ** 20)
             if not data:
                 break
+            if rate_limit:
+                rate_limit.take(len(data))
             sha.update(data)
+            size += len(data)
+    METRICS.count('peep_hashed_bytes_total', size)
+    return encoded_hash(sha)
+
+
+# What a peep hash of a sha256 looks like, and thus what can name a store entry
+STORE_KEY_RE = re.compile(r'^[A-Za-z0-9_-]{43}$')
+
+
+def makedirs(path, mode=0o777):
+    """Make a directory and any missing parents, tolerating its already
+    existing.
+
+    :arg mode: The permissions of any directories made, before the umask
+
+    """
+    try:
+        os.makedirs(path, mode)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+class ArchiveStore(object):
+    """A content-addressed directory of archives which passed verification,
+    shareable among peep processes
+
+    Each archive lives at ``<root>/<hash>/<filename>``, where ``hash`` is its
+    peep hash. The store is only a cache: anything taken out of it is copied
+    into a private temp dir and hashed again before being trusted, so
+    tampering with it can cause a mismatch but never a bad install.
+
+    """
+    def __init__(self, root):
+        self.root = root
+
+    # Whether this OS can keep concurrent peep processes from fetching the
+    # same archive at once
+    can_lock = fcntl is not None
+
+    @contextmanager
+    def lock(self, hashes):
+        """Take an exclusive lock on each of some hashes for the duration of a
+        ``with`` block, waiting for any other process (or thread) holding
+        one, so only one fetches an archive at a time.
+
+        Processes whose requirements list different hashes for the same
+        archive still agree on the archive's own hash, so they contend for
+        that one. Locks are taken in sorted order, so overlapping sets can't
+        deadlock. Anything not shaped like a store key is skipped.
+
+        The locks are advisory, and the OS releases them when their holder
+        dies, so a crash can't leave them stuck. Staging dirs for a hash found
+        upon taking its lock were left by a holder that died mid-``add()``, so
+        they're cleaned up.
+
+        """
+        lock_dir = join(self.root, '.locks')
+        makedirs(lock_dir)
+        files = []
+        try:
+            for hash in sorted(set(h for h in hashes if STORE_KEY_RE.match(h))):
+                file = open(join(lock_dir, hash), 'a')
+                files.append(file)
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+                for leftover in glob(join(self.root, '.incoming-%s-*' % hash)):
+                    rmtree(leftover, ignore_errors=True)
+            yield
+        finally:
+            for file in reversed(files):
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+                file.close()
+
+    def hashes(self):
+        """Return the hashes of all the entries in the store."""
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return []
+        return sorted(n for n in names if STORE_KEY_RE.match(n))
+
+    def quarantine(self, hash):
+        """Move an entry out of the store, into ``<root>/.quarantine`` for a
+        human to look at, and return where it went."""
+        dest = join(self.root, '.quarantine', '%s-%d' % (hash, time()))
+        makedirs(dirname(dest))
+        os.rename(join(self.root, hash), dest)
+        return dest
+
+    def path(self, hash):
+        """Return the path of the stored archive having the given hash, or
+        None if there isn't one."""
+        if not STORE_KEY_RE.match(hash):
+            return None
+        try:
+            names = [n for n in os.listdir(join(self.root, hash))
+                     if not n.startswith('.')]
+        except OSError:
+            return None
+        return join(self.root, hash, names[0]) if names else None
+
+    def add(self, path, hash):
+        """Copy a verified archive into the store, if it isn't there already.
+
+        Entries appear atomically, so concurrent readers never see a partial
+        file.
+
+        """
+        if not STORE_KEY_RE.match(hash) or self.path(hash):
+            return
+        makedirs(self.root)
+        staging = mkdtemp(prefix='.incoming-%s-' % hash, dir=self.root)
+        try:
+            copy(path, staging)
+            os.rename(staging, join(self.root, hash))
+        except OSError:
+            # Probably another process stored the same archive first.
+            rmtree(staging, ignore_errors=True)
+
+
+# The Linux ioctl that makes a file a copy-on-write clone of another, from
+# linux/fs.h
+FICLONE = 0x40049409
+
+
+def reflink(source, dest):
+    """Make the open file ``dest`` a copy-on-write clone of the open file
+    ``source``, sharing its blocks until either is written to, and return
+    True. Return False if the filesystem can't (only some, like Btrfs and
+    XFS, can)."""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(dest.fileno(), FICLONE, source.fileno())
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def copy_and_hash(source, dest):
+    """Copy a file, and return the hash of the copy.
+
+    Where the filesystem allows, the copy is a clone, which costs nothing to
+    make, so it's read only to hash it. Otherwise, the hash comes from the
+    same reads that make the copy. Either way, the file is read once, and the
+    hash is of exactly what the private copy holds, however the source
+    changes later. (A hard link would be cheaper still but would share those
+    changes.)
+
+    """
+    with open(source, 'rb') as source_file:
+        with open(dest, 'wb') as dest_file:
+            if reflink(source_file, dest_file):
+                sha = None
+            else:
+                sha = sha256()
+                size = 0
+                while True:
+                    data = source_file.read(2 ** 20)
+                    if not data:
+                        break
+                    sha.update(data)
+                    dest_file.write(data)
+                    size += len(data)
+    if sha is None:
+        return hash_of_file(dest)
+    METRICS.count('peep_hashed_bytes_total', size)
+    return encoded_hash(sha)
+
+
+def mapped_hash_of_file(path):
+    """Return the hash of a file, reading it through a memory map, or None if
+    the file can't be read.
+
+    This is faster than ``hash_of_file()`` for the many small files of an
+    installed package, since it skips copying everything through buffers.
+
+    """
+    try:
+        with open(path, 'rb') as file:
+            sha = sha256()
+            if os.fstat(file.fileno()).st_size:
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    sha.update(mapped)
+                finally:
+                    mapped.close()
+    except (IOError, OSError, ValueError):
+        return None
     return encoded_hash(sha)
 
 
+# Names of files and dirs left out of tree hashes wherever they are: VCS
+# bookkeeping and build litter. A .peepignore file at the root of a tree can
+# add more, one per line, matching either names or paths relative to the root.
+TREE_IGNORED = ['.git', '.hg', '.svn', '.bzr', 'CVS', '__pycache__', '*.egg-info',
+                '*.pyc', '*.pyo']
+
+
+def tree_entries(root):
+    """Return a list of (path relative to ``root`` with "/" separators,
+    absolute path) of the files and symlinks in a tree that aren't ignored,
+    sorted by relative path."""
+    patterns = list(TREE_IGNORED)
+    try:
+        with open(join(root, '.peepignore')) as file:
+            patterns.extend(line.strip() for line in file
+                            if line.strip() and not line.startswith('#'))
+    except IOError:
+        pass
+
+    def ignored(relative):
+        name = relative.rsplit('/', 1)[-1]
+        return any(fnmatchcase(name, p) or fnmatchcase(relative, p) for p in patterns)
+
+    entries = []
+    prefixes = {root: ''}
+    for dir_path, dir_names, file_names in os.walk(root):
+        prefix = prefixes.pop(dir_path)
+        links = [name for name in dir_names if os.path.islink(join(dir_path, name))]
+        dir_names[:] = [name for name in dir_names
+                        if name not in links and not ignored(prefix + name)]
+        for name in dir_names:
+            prefixes[join(dir_path, name)] = prefix + name + '/'
+        entries.extend((prefix + name, join(dir_path, name))
+                       for name in file_names + links if not ignored(prefix + name))
+    return sorted(entries, key=lambda entry: utf8(entry[0]))
+
+
+def utf8(text):
+    """Return text as UTF-8 bytes, whether it's unicode or bytes already."""
+    return text if isinstance(text, bytes) else text.encode('utf-8')
+
+
+def tree_hash(root):
+    """Return the peep hash of a directory tree.
+
+    It's the hash of a manifest with a line for each file and symlink that
+    isn't ignored, in sorted order, giving its mode normalized to 755 or 644
+    (or 120000 for a symlink), the hash of its contents (or link target), and
+    its relative path. Thus, it doesn't vary with timestamps,
+    owners, umasks, or the order the filesystem lists things in. Files are
+    hashed concurrently.
+
+    Every file is read afresh each time: a tree is what gets installed, so
+    trusting stat() to say nothing changed since it was last hashed would
+    let edits slip past verification.
+
+    """
+    def line(entry):
+        relative, path = entry
+        status = os.lstat(path)
+        if S_ISLNK(status.st_mode):
+            return manifest_line(relative, '120000', link_hash(os.readlink(path)))
+        digest = mapped_hash_of_file(path)
+        if digest is None:
+            raise UnsupportedRequirementError("Couldn't read %s to hash it." % path)
+        return manifest_line(relative, file_mode(status), digest)
+
+    return manifest_hash(in_parallel(line, tree_entries(root), cpu_count()))
+
+
+def copy_tree_and_hash(source, dest):
+    """Copy the files and symlinks of a directory tree which a tree hash
+    covers into a new dir, and return the tree hash of the copy.
+
+    As with ``copy_and_hash()``, each file is read once, and the hash is of
+    exactly what the copy holds, however the source changes meanwhile.
+    Ignored things, like VCS metadata, aren't copied.
+
+    """
+    def line(entry):
+        relative, path = entry
+        target = join(dest, *relative.split('/'))
+        makedirs(dirname(target))
+        if os.path.islink(path):
+            link = os.readlink(path)
+            os.symlink(link, target)
+            return manifest_line(relative, '120000', link_hash(link))
+        try:
+            digest = copy_and_hash(path, target)
+            copymode(path, target)
+        except (IOError, OSError):
+            raise UnsupportedRequirementError("Couldn't copy %s to hash it." % path)
+        return manifest_line(relative, file_mode(os.stat(target)), digest)
+
+    makedirs(dest)
+    return manifest_hash(in_parallel(line, tree_entries(source), cpu_count()))
+
+
+def file_mode(status):
+    """Return the mode of a file as a tree hash records it, normalized to 755
+    or 644."""
+    return '755' if status.st_mode & 0o111 else '644'
+
+
+def link_hash(target):
+    """Return the hash a tree hash records for a symlink: that of its
+    target."""
+    return encoded_hash(sha256(utf8(target)))
+
+
+def manifest_line(relative, mode, digest):
+    """Return the line of a tree hash's manifest for one file or symlink."""
+    return utf8('%s %s ' % (mode, digest)) + utf8(relative) + b'\n'
+
+
+def manifest_hash(lines):
+    """Return the tree hash of a manifest made of some sorted lines."""
+    return encoded_hash(sha256(b'peep tree 1\n' + b''.join(lines)))
+
+
+# The VCSes pip can check out from, as they appear in URL schemes like
+# "git+https"
+VCS_NAMES = ['git', 'hg', 'svn', 'bzr']
+
+
+def is_tree_url(url):
+    """Return whether a requirement's URL (or None) is a VCS checkout or a
+    local directory, to be hashed as a tree rather than as an archive."""
+    if not url:
+        return False
+    scheme = url.split(':', 1)[0].lower()
+    if scheme == 'file':
+        return isdir(url2pathname(urlparse(url).path))
+    return scheme.split('+', 1)[0] in VCS_NAMES
+
+
 def is_git_sha(text):
     """Return whether this is probably a git sha"""
     # Handle both the full sha as well as the 7-character abbreviation
@@ -244,6 +963,24 @@ def filename_from_url(url):
     return path.split('/')[-1]
 
 
+def url_is_always_unsatisfied(url):
+    """Return whether a requirement with the given URL (or None) should be
+    reinstalled even if its version is installed."""
+    # Trees change without their version numbers changing:
+    if is_tree_url(url):
+        return True
+    # If this is a github sha tarball, then it is always unsatisfied
+    # because the url has a commit sha in it and not the version
+    # number.
+    if url:
+        filename = filename_from_url(url)
+        if filename.endswith(ARCHIVE_EXTENSIONS):
+            filename, ext = splitext(filename)
+            if is_git_sha(filename):
+                return True
+    return False
+
+
 def requirement_args(argv, want_paths=False, want_other=False):
     """Return an iterable of filtered arguments.
 
@@ -268,6 +1005,126 @@ def requirement_args(argv, want_paths=False, want_other=False):
             if want_other:
                 yield arg
 
+
+def requirement_paths(argv, why):
+    """Return the paths of the requirements files given with ``-r``. Raise
+    OptionError if there are none.
+
+    :arg why: The end of the error message, saying why peep needs them
+
+    """
+    paths = list(requirement_args(argv, want_paths=True))
+    if not paths:
+        raise OptionError('You have to specify one or more requirements files '
+                          'with the -r option, %s' % why)
+    return paths
+
+
+# Why most subcommands need requirements files
+NEED_HASHES = "because\notherwise there's nowhere for peep to look up the hashes."
+
+
+# Where peep keeps things between runs by default
+PEEP_DIR = join(expanduser('~'), '.peep')
+
+# Where ``peep serve`` listens and ``peep install --daemon`` connects by default
+DEFAULT_SOCKET = join(PEEP_DIR, 'serve.sock')
+
+# Options peep handles itself rather than passing through to pip, as tuples
+# of (option string, dest, action, default). The actions mean what they do in
+# optparse, plus "int", which is like "store" but for integers.
+PEEP_OPTIONS = [
+    ('--daemon', 'daemon', 'store_true', False),
+    ('--socket', 'socket', 'store', DEFAULT_SOCKET),
+    ('--store', 'store', 'store', None),
+    ('--hash-server', 'hash_servers', 'append', []),
+    ('--shard', 'shard', 'store', None),
+    ('--jobs', 'jobs', 'int', 1),
+    ('--max-per-host', 'max_per_host', 'int', 4),
+    ('--size-stats', 'size_stats', 'store', join(PEEP_DIR, 'sizes.json')),
+    ('--target-env', 'target_envs', 'append', []),
+    ('--all-artifacts', 'all_artifacts', 'store_true', False),
+    ('--metrics-file', 'metrics_file', 'store', None),
+    ('--statsd', 'statsd', 'store', None),
+    ('--limit-rate', 'limit_rate', 'store', None),
+    ('--small-first', 'small_first', 'store_true', False),
+    ('--segments', 'segments', 'int', 4),
+    ('--segment-above', 'segment_above', 'store', '64M'),
+    ('--output', 'output', 'store', None),
+    ('--only', 'only', 'store', None),
+    ('--force', 'force', 'store_true', False),
+    ('--fingerprints', 'fingerprints', 'store', join(PEEP_DIR, 'installed.json')),
+    ('--compile-levels', 'compile_levels', 'store', '0'),
+]
+
+
+def peep_options(argv, **defaults):
+    """Separate the options peep handles itself from those bound for pip.
+
+    Return an optparse ``Values`` of peep's options and a list of the other
+    args, in order. Peep's options must be spelled out in full, so they can't
+    be mistaken for abbreviations of pip's. Raise OptionError if one lacks its
+    value.
+
+    :arg argv: The commandline args, starting after the subcommand
+    :arg defaults: Defaults to use instead of those in ``PEEP_OPTIONS``, by
+        dest, for subcommands that want different ones
+
+    """
+    specs = dict((spec[0], spec) for spec in PEEP_OPTIONS)
+    options = Values(dict((dest, list(default) if action == 'append' else default)
+                          for _, dest, action, default in PEEP_OPTIONS))
+    for dest, default in defaults.items():
+        setattr(options, dest, default)
+    other = []
+    was_r = False
+    args = iter(argv)
+    for arg in args:
+        flag, equals, value = arg.partition('=')
+        spec = None if was_r else specs.get(flag)
+        was_r = arg in ['-r', '--requirement']
+        if spec is None:
+            other.append(arg)
+            continue
+        _, dest, action, _ = spec
+        if action == 'store_true':
+            setattr(options, dest, True)
+            continue
+        if not equals:
+            value = next(args, None)
+            if value is None:
+                raise OptionError('%s requires an argument.' % flag)
+        if action == 'int':
+            try:
+                value = int(value)
+            except ValueError:
+                raise OptionError('%s requires an integer.' % flag)
+        if action == 'append':
+            getattr(options, dest).append(value)
+        else:
+            setattr(options, dest, value)
+    return options, other
+
+
+def without_options(argv, flags):
+    """Return a copy of ``argv`` with the given peep options, and any values
+    they take, left out."""
+    takes_value = dict((flag, action != 'store_true')
+                       for flag, _, action, _ in PEEP_OPTIONS)
+    ret = []
+    skip_next = was_r = False
+    for arg in argv:
+        flag, equals, _ = arg.partition('=')
+        if skip_next:
+            skip_next = False
+        elif not was_r and flag in flags:
+            skip_next = takes_value[flag] and not equals
+        else:
+            ret.append(arg)
+        was_r = arg in ['-r', '--requirement']
+    return ret
+
+
 # any line that is a comment or just whitespace
 IGNORED_LINE_RE = re.compile(r'^(\s*#.*)?\s*$')
 
@@ -283,6 +1140,31 @@ HASH_COMMENT_RE = re.compile(
                                #   and are optional.
     $""", re.X)
 
+# The same, but for the hash of a directory tree, as from ``tree_hash()``
+TREE_HASH_COMMENT_RE = re.compile(
+    r"""
+    \s*\#\s+
+    tree-sha256:\s+
+    (?P<hash>[^\s]+)
+    \s*
+    (?:\#(?P<comment>.*))?
+    $""", re.X)
+
+# pip 8's way of pinning a hash: an option on the requirement line itself,
+# with the digest in hex
+HASH_OPTION_RE = re.compile(r'(?:^|\s)--hash(?:=|\s+)(?P<algorithm>[a-z0-9]+):(?P<digest>\S*)')
+
+# A hint at the size of a requirement's archive, for dividing up and
+# scheduling work before we've downloaded anything, e.g. "# size: 600M"
+SIZE_COMMENT_RE = re.compile(
+    r"""
+    \s*\#\s+
+    size:\s+
+    (?P<size>\d+(?:\.\d+)?\s*[KMGkmg]?[Bb]?)
+    \s*
+    (?:\#(?P<comment>.*))?
+    $""", re.X)
+
 
 def peep_hash(argv):
     """Return the peep hash of one or more files, returning a shell status code
@@ -295,11 +1177,15 @@ def peep_hash(argv):
         usage='usage: %prog hash file [file ...]',
         description='Print a peep hash line for one or more files: for '
                     'example, "# sha256: '
-                    'oz42dZy6Gowxw8AelDtO4gRgTW_xPdooH484k7I5EOY".')
+                    'oz42dZy6Gowxw8AelDtO4gRgTW_xPdooH484k7I5EOY". '
+                    'Directories get "# tree-sha256:" lines.')
     _, paths = parser.parse_args(args=argv)
     if paths:
         for path in paths:
-            print('# sha256:', hash_of_file(path))
+            if isdir(path):
+                print('# tree-sha256:', tree_hash(path))
+            else:
+                print('# sha256:', hash_of_file(path))
         return ITS_FINE_ITS_FINE
     else:
         parser.print_usage()
@@ -333,12 +1219,43 @@ def memoize(func):
     return memoizer
 
 
-def package_finder(argv):
-    """Return a PackageFinder respecting command-line options.
+def remember(obj, method_name, value):
+    """Prime the memo of a @memoize'd method, for when we learn its answer as
+    a side effect of doing something else."""
+    if not hasattr(obj, '_cache'):
+        obj._cache = {}
+    obj._cache[method_name] = value
 
-    :arg argv: Everything after the subcommand
+
+def timed(name):
+    """Add the time a method takes to its instance's ``_timings`` dict, under
+    ``name``."""
+    def decorator(func):
+        @wraps(func)
+        def timer(self, *args, **kwargs):
+            start = time()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self._timings[name] = self._timings.get(name, 0) + time() - start
+        return timer
+    return decorator
+
+
+# An InstallCommand and the pickle of its arg parser, once made
+_INSTALL_COMMAND = []
+
+
+def _install_command():
+    """Return an InstallCommand and a pickle of its arg parser.
+
+    Both are expensive to make and are never modified in place, so we make
+    them only once per process.
 
     """
+    if _INSTALL_COMMAND:
+        return _INSTALL_COMMAND[0]
+
     # We instantiate an InstallCommand and then use some of its private
     # machinery--its arg parser--for our own purposes, like a virus. This
     # approach is portable across many pip versions, where more fine-grained
@@ -359,7 +1276,32 @@ def package_finder(argv):
     # Thus, we deepcopy the arg parser so we don't trash its singletons. Of
     # course, deepcopy doesn't work on these objects, because they contain
     # uncopyable regex patterns, so we pickle and unpickle instead. Fun!
-    options, _ = loads(dumps(command.parser)).parse_args(argv)
+    _INSTALL_COMMAND.append((command, dumps(command.parser)))
+    return _INSTALL_COMMAND[0]
+
+
+def refresh_pip_config():
+    """Have the cached arg parser read pip's config files afresh, picking up
+    changes made since it was built, as a long-running ``peep serve`` needs
+    to."""
+    command, pickled_parser = _install_command()
+    parser = loads(pickled_parser)
+    if hasattr(parser, 'get_config_files'):
+        parser.config = parser.config.__class__()
+        parser.files = parser.get_config_files()
+        parser.config.read(parser.files)
+        _INSTALL_COMMAND[0] = command, dumps(parser)
+
+
+def package_finder(argv):
+    """Return a PackageFinder respecting command-line options.
+
+    :arg argv: Everything after the subcommand
+
+    """
+    load_pip()
+    command, pickled_parser = _install_command()
+    options, _ = loads(pickled_parser).parse_args(argv)
 
     # Carry over PackageFinder kwargs that have [about] the same names as
     # options attr names:
@@ -398,17 +1340,37 @@ class DownloadedReq(object):
     expensive things.
 
     """
-    def __init__(self, req, argv, finder):
+    def __init__(self, req, argv, finder, options=None, duplicates=(), targets=None):
         """Download a requirement, compare its hashes, and return a subclass
         of DownloadedReq depending on its state.
 
         :arg req: The InstallRequirement I am based on
         :arg argv: The args, starting after the subcommand
+        :arg options: peep's own options, as from ``peep_options()``
+        :arg duplicates: Other InstallRequirements for the very same thing,
+            from elsewhere in the requirements files, whose hashes I should
+            accept as well
+        :arg targets: The interpreters of the target environments I'm not yet
+            installed in, or None to install into our own environment
 
         """
         self._req = req
+        self._duplicates = list(duplicates)
+        self._targets = targets
         self._argv = argv
         self._finder = finder
+        if options is None:
+            options, _ = peep_options([])
+        self._store = ArchiveStore(options.store) if options.store else None
+        self._hash_servers = options.hash_servers
+        # When just fetching into the store, nothing counts as installed:
+        self._fetch_only = getattr(options, 'fetch_only', False)
+        self._host_slots = getattr(options, 'host_slots', None)
+        self._rate_limit = getattr(options, 'rate_limit', None)
+        self._segments = options.segments
+        self._segment_threshold = getattr(options, 'segment_threshold', None)
+        self._progress = getattr(options, 'progress', None) or Progress()
+        self._optimization_levels = getattr(options, 'optimization_levels', [0])
 
         # We use a separate temp dir for each requirement so requirements
         # (from different indices) that happen to have the same archive names
@@ -416,10 +1378,15 @@ class DownloadedReq(object):
         # latter is a hash mismatch, the former has already passed the
         # comparison, and the latter gets installed.
         self._temp_path = mkdtemp(prefix='peep-')
+        self._timings = {}
         # Think of DownloadedReq as a one-shot state machine. It's an abstract
         # class that ratchets forward to being one of its own subclasses,
         # depending on its package status. Then it doesn't move again.
         self.__class__ = self._class()
+        METRICS.count('peep_requirements_total', kind=self.__class__.__name__)
+        if self._store and self.__class__ is InstallableReq and not self._is_tree():
+            self._store.add(join(self._temp_path, self._downloaded_filename()),
+                            self._actual_hash())
 
     def dispose(self):
         """Delete temp files and dirs I've made. Render myself useless.
@@ -477,22 +1444,39 @@ class DownloadedReq(object):
         from the filename.
 
         """
-        # If this is a github sha tarball, then it is always unsatisfied
-        # because the url has a commit sha in it and not the version
-        # number.
-        url = self._url()
-        if url:
-            filename = filename_from_url(url)
-            if filename.endswith(ARCHIVE_EXTENSIONS):
-                filename, ext = splitext(filename)
-                if is_git_sha(filename):
-                    return True
-        return False
+        return url_is_always_unsatisfied(self._url())
 
     @memoize  # Avoid hitting the file[cache] over and over.
     def _expected_hashes(self):
         """Return a list of known-good hashes for this package."""
-        return hashes_above(*path_and_line(self._req))
+        hashes = []
+        for hash in chain.from_iterable(self._hashes_by_req()):
+            if hash not in hashes:
+                hashes.append(hash)
+        return hashes
+
+    def _hashes_by_req(self):
+        """Return the list of hashes above each line that asks for me."""
+        above = tree_hashes_above if self._is_tree() else hashes_above
+        return [above(*path_and_line(req))
+                for req in [self._req] + self._duplicates]
+
+    @memoize
+    def _is_tree(self):
+        """Return whether I'm a directory or VCS checkout, hashed with
+        ``tree_hash()``, rather than an archive."""
+        return is_tree_url(self._url())
+
+    def _hash_comment(self, hash):
+        """Return the comment line which would pin me to a hash."""
+        return '# %s: %s' % ('tree-sha256' if self._is_tree() else 'sha256', hash)
+
+    def _has_conflicting_hashes(self):
+        """Return whether any two of the lines asking for me specify hashes
+        with none in common."""
+        hash_sets = [set(hashes) for hashes in self._hashes_by_req() if hashes]
+        return any(not a & b for i, a in enumerate(hash_sets)
+                   for b in hash_sets[i + 1:])
 
     def _download(self, link):
         """Download a file, and return its name within my temp dir.
@@ -530,9 +1514,12 @@ class DownloadedReq(object):
             content_disposition = response.info().get('content-disposition')
             if content_disposition:
                 type, params = cgi.parse_header(content_disposition)
-                # We use ``or`` here because we don't want to use an "empty" value
-                # from the filename param:
-                filename = params.get('filename') or filename
+                # Take just the last component, since a hash server needn't be
+                # trusted and mustn't be able to aim us outside the temp dir.
+                # We use ``or`` here because we don't want to use an "empty"
+                # value from the filename param:
+                given = basename(params.get('filename') or '')
+                filename = given if given not in ('', os.curdir, os.pardir) else filename
             ext = splitext(filename)[1]
             if not ext:
                 ext = mimetypes.guess_extension(content_type)
@@ -556,105 +1543,382 @@ class DownloadedReq(object):
                 downloads)
 
             """
-            def response_chunks(chunk_size):
+            announce(size)
+            with open(path, 'wb') as file:
+                for chunk in self._progress.track(response_chunks(response), size):
+                    file.write(chunk)
+
+        def response_chunks(response):
+            """Yield the body of an HTTP response in 4K chunks, no faster
+            than the rate limit allows."""
+            def chunks():
                 while True:
-                    chunk = response.read(chunk_size)
+                    chunk = response.read(4096)
                     if not chunk:
                         break
                     yield chunk
+            if self._rate_limit:
+                return self._rate_limit.throttle(chunks())
+            return chunks()
 
-            print('Downloading %s%s...' % (
+        def announce(size):
+            self._progress.note('Downloading %s%s...' % (
                 self._req.req,
                 (' (%sK)' % (size / 1000)) if size > 1000 else ''))
-            progress_indicator = (DownloadProgressBar(max=size).iter if size
-                                  else DownloadProgressSpinner().iter)
+
+        def can_segment(response, size):
+            """Return whether a download is big enough to be worth fetching
+            in segments and comes from a server that can serve them."""
+            info = response.info()
+            return (self._segments > 1 and
+                    self._segment_threshold is not None and
+                    size >= self._segment_threshold and
+                    info.get('accept-ranges', '').lower() == 'bytes' and
+                    not info.get('content-encoding'))
+
+        def fetch_segments(url, path, size):
+            """Download an archive as several byte ranges at once, each
+            written into its place in a preallocated file, and show progress.
+
+            :arg url: The URL to fetch, after any redirects
+            :arg path: The path of the new file
+            :arg size: The size, in bytes, of the whole archive
+
+            """
             with open(path, 'wb') as file:
-                for chunk in progress_indicator(response_chunks(4096), 4096):
-                    file.write(chunk)
+                file.truncate(size)
+            count = min(self._segments, size)
+            starts = [size * i // count for i in range(count + 1)]
+            # Each segment thread posts None when it's done or the exception
+            # that stopped it.
+            posts = Queue()
+
+            def fetch_segment(start, end):
+                # Post whatever goes wrong, lest the main thread wait forever:
+                try:
+                    with host_slot(url):
+                        request = Request(url, headers={
+                            'Range': 'bytes=%s-%s' % (start, end - 1)})
+                        response = opener(urlparse(url).scheme != 'http').open(request)
+                        content_range = response.info().get('content-range', '')
+                        if (response.getcode() != 206 or
+                                not content_range.startswith('bytes %s-' % start)):
+                            raise IOError('The server ignored a request for bytes '
+                                          '%s-%s.' % (start, end - 1))
+                        with open(path, 'r+b') as file:
+                            file.seek(start)
+                            for chunk in response_chunks(response):
+                                chunk = chunk[:end - file.tell()]
+                                file.write(chunk)
+                                self._progress.advance(key, len(chunk))
+                            if file.tell() != end:
+                                raise IOError('Bytes %s-%s ended early.' % (start, end - 1))
+                except Exception as exc:
+                    posts.put(exc)
+                else:
+                    posts.put(None)
+
+            announce(size)
+            key = self._progress.start(size)
+            try:
+                for i in range(count):
+                    thread = Thread(target=fetch_segment, args=(starts[i], starts[i + 1]))
+                    thread.daemon = True
+                    thread.start()
+                errors = [post for post in (posts.get() for _ in range(count))
+                          if post is not None]
+            finally:
+                self._progress.finish(key)
+            if errors:
+                raise errors[0]
+
+        @contextmanager
+        def host_slot(url):
+            """Hold one of the connection slots for a URL's host, if
+            connections are capped, for the duration of a ``with`` block."""
+            if self._host_slots:
+                with self._host_slots(urlparse(url).netloc):
+                    yield
+            else:
+                yield
 
-        url = link.url.split('#', 1)[0]
-        try:
-            response = opener(urlparse(url).scheme != 'http').open(url)
-        except (HTTPError, IOError) as exc:
-            raise DownloadError(link, exc)
-        filename = best_filename(link, response)
-        try:
-            size = int(response.headers['content-length'])
-        except (ValueError, KeyError, TypeError):
-            size = 0
-        pipe_to_file(response, join(self._temp_path, filename), size=size)
-        return filename
+        def transfer(url):
+            """Fetch a URL into my temp dir, and return the filename.
+
+            A connection slot is held throughout, except that a download in
+            segments lets go of it and has each segment take its own.
+
+            """
+            host = urlparse(url).netloc
+            start = time()
+            with host_slot(url):
+                try:
+                    response = opener(urlparse(url).scheme != 'http').open(url)
+                except (HTTPError, IOError) as exc:
+                    METRICS.count('peep_download_errors_total', host=host)
+                    raise DownloadError(link, exc)
+                METRICS.observe('peep_download_latency_seconds', time() - start, host=host)
+                filename = best_filename(link, response)
+                try:
+                    size = int(response.headers['content-length'])
+                except (ValueError, KeyError, TypeError):
+                    size = 0
+                path = join(self._temp_path, filename)
+                segmented = can_segment(response, size)
+                if segmented:
+                    response.close()
+                else:
+                    pipe_to_file(response, path, size=size)
+            if segmented:
+                try:
+                    fetch_segments(response.geturl(), path, size)
+                except Exception as exc:
+                    METRICS.count('peep_download_errors_total', host=host)
+                    raise DownloadError(link, exc)
+            if METRICS.enabled:
+                METRICS.observe('peep_download_seconds', time() - start, host=host)
+                METRICS.count('peep_downloaded_bytes_total', os.path.getsize(path),
+                              host=host)
+            return filename
+
+        return transfer(link.url.split('#', 1)[0])
 
     # Based on req_set.prepare_files() in pip bb2a8428d4aebc8d313d05d590f386fa3f0bbd0f
     @memoize  # Avoid re-downloading.
+    @timed('download')
     def _downloaded_filename(self):
         """Download the package's archive if necessary, and return its
         filename.
 
+        For a tree, return the name of the dir a VCS checkout was exported,
+        or a local directory copied, to.
+
         --no-deps is implied, as we have reimplemented the bits that would
         ordinarily do dependency resolution.
 
         """
-        # Peep doesn't support requirements that don't come down as a single
-        # file, because it can't hash them. Thus, it doesn't support editable
-        # requirements, because pip itself doesn't support editable
-        # requirements except for "local projects or a VCS url". Nor does it
-        # support VCS requirements yet, because we haven't yet come up with a
-        # portable, deterministic way to hash them. In summary, all we support
-        # is == requirements and tarballs/zips/etc.
+        # Peep supports == requirements and tarballs/zips/etc., which it
+        # hashes as files, and local directories and VCS URLs, which it
+        # hashes as trees. It doesn't support editable requirements, since
+        # they're meant to change after installation.
 
         # TODO: Stop on reqs that are editable or aren't ==.
 
+        if self._is_tree():
+            return self._tree()
+
+        # If the store has an archive we'd accept, skip the index and the
+        # download. The copy gets hashed like any other file.
+        stored = self._stored_archive()
+        if stored:
+            METRICS.count('peep_archive_sources_total', source='store')
+            return self._copy(stored)
+        if self._store and self._store.can_lock and self._expected_hashes():
+            return self._fetched_single_flight()
+        return self._fetched()
+
+    def _fetched_single_flight(self):
+        """Fetch my archive, unless another process sharing my store is
+        fetching it already, in which case wait for it and use what it
+        stored. Return the filename as ``_downloaded_filename()`` does.
+
+        """
+        start = time()
+        with self._store.lock(self._expected_hashes()):
+            METRICS.observe('peep_store_lock_wait_seconds', time() - start)
+            stored = self._stored_archive()
+            if stored:
+                METRICS.count('peep_archive_sources_total', source='store')
+                return self._copy(stored)
+            filename = self._fetched()
+            # Store it before letting go of the lock, so waiters find it:
+            path = join(self._temp_path, filename)
+            actual = getattr(self, '_cache', {}).get('_actual_hash') or self._hash_file(path)
+            remember(self, '_actual_hash', actual)
+            if actual in self._expected_hashes():
+                self._store.add(path, actual)
+            return filename
+
+    def _fetched(self):
+        """Get my archive from a hash server, a file:// URL, or the web, and
+        return its filename, as ``_downloaded_filename()`` does."""
+        from_server = self._download_from_hash_server()
+        if from_server:
+            METRICS.count('peep_archive_sources_total', source='hash_server')
+            return from_server
+
         # If the requirement isn't already specified as a URL, get a URL
         # from an index:
-        link = self._link() or self._finder.find_requirement(self._req, upgrade=False)
+        link = self._link() or self._find_requirement()
 
         if link:
             lower_scheme = link.scheme.lower()  # pip lower()s it for some reason.
+            METRICS.count('peep_archive_sources_total', source=lower_scheme)
             if lower_scheme == 'http' or lower_scheme == 'https':
                 file_path = self._download(link)
                 return basename(file_path)
             elif lower_scheme == 'file':
                 # The following is inspired by pip's unpack_file_url():
-                link_path = url_to_path(link.url_without_fragment)
-                if isdir(link_path):
-                    raise UnsupportedRequirementError(
-                        "%s: %s is a directory. So that it can compute "
-                        "a hash, peep supports only filesystem paths which "
-                        "point to files" %
-                        (self._req, link.url_without_fragment))
-                else:
-                    copy(link_path, self._temp_path)
-                    return basename(link_path)
+                return self._copy(url_to_path(link.url_without_fragment))
             else:
                 raise UnsupportedRequirementError(
                     "%s: The download link, %s, would not result in a file "
-                    "that can be hashed. Peep supports only == requirements, "
-                    "file:// URLs pointing to files (not folders), and "
-                    "http:// and https:// URLs pointing to tarballs, zips, "
-                    "etc." % (self._req, link.url))
+                    "or tree that can be hashed. Peep supports only == "
+                    "requirements, file:// URLs, VCS URLs, and http:// and "
+                    "https:// URLs pointing to tarballs, zips, etc." %
+                    (self._req, link.url))
         else:
             raise UnsupportedRequirementError(
                 "%s: couldn't determine where to download this requirement from."
                 % (self._req,))
 
-    def install(self):
+    def _tree(self):
+        """Copy my local directory, or export my VCS checkout, into my temp
+        dir, without its VCS metadata, and return the name of the dir it went
+        into."""
+        url = self._url()
+        path = join(self._temp_path, 'tree')
+        if url.lower().startswith('file:'):
+            # Hash it as it's copied, so what pip installs is what we hashed,
+            # whatever happens to the original meanwhile:
+            remember(self, '_actual_hash',
+                     copy_tree_and_hash(url_to_path(url.split('#', 1)[0]), path))
+        else:
+            backend = vcs.get_backend(url.split(':', 1)[0].split('+', 1)[0].lower())
+            backend(url).export(path)
+        return 'tree'
+
+    @measured('peep_find_seconds')
+    def _find_requirement(self):
+        """Ask the index where to download me from."""
+        return self._finder.find_requirement(self._req, upgrade=False)
+
+    def _copy(self, path):
+        """Copy a local archive into my temp dir, where it can't change out
+        from under us, hashing it along the way, and return its filename."""
+        filename = basename(path)
+        remember(self, '_actual_hash',
+                 copy_and_hash(path, join(self._temp_path, filename)))
+        return filename
+
+    def _stored_archive(self):
+        """Return the path of an archive in the store which has one of my
+        expected hashes, or None."""
+        if self._store:
+            for hash in self._expected_hashes():
+                path = self._store.path(hash)
+                if path:
+                    return path
+
+    def _download_from_hash_server(self):
+        """Try to fetch an archive having one of my expected hashes from the
+        ``--hash-server`` URLs, and return its filename, or None if none of them
+        had one.
+
+        Whatever a server sends is hashed straight away, and a bad archive is
+        thrown out in favor of the next source, so servers needn't be trusted.
+
+        """
+        for server in self._hash_servers:
+            for hash in self._expected_hashes():
+                if not STORE_KEY_RE.match(hash):
+                    continue
+                try:
+                    filename = self._download(Link(server.rstrip('/') + '/' + hash))
+                except DownloadError:
+                    continue  # It doesn't have it, or it's down.
+                path = join(self._temp_path, filename)
+                actual = hash_of_file(path)
+                if actual in self._expected_hashes():
+                    remember(self, '_actual_hash', actual)
+                    return filename
+                print('%s sent a bad archive for %s. Ignoring it.' %
+                      (server, self._req))
+                os.remove(path)
+
+    def install(self, python=None, prefix=None, compile=True):
         """Install the package I represent, without dependencies.
 
         Obey typical pip-install options passed in on the command line.
 
+        :arg python: The interpreter of a target environment to install into,
+            rather than our own
+        :arg prefix: A directory to install into as if it were an empty
+            environment, as for ``peep bundle``
+        :arg compile: False to have pip leave bytecode compilation to us
+
         """
         other_args = list(requirement_args(self._argv, want_other=True))
         archive_path = join(self._temp_path, self._downloaded_filename())
         # -U so it installs whether pip deems the requirement "satisfied" or
         # not. This is necessary for GitHub-sourced zips, which change without
-        # their version numbers changing.
-        run_pip(['install'] + other_args + ['--no-deps', '-U', archive_path])
+        # their version numbers changing. Into a prefix, -I instead, lest pip
+        # uninstall the version in our own environment.
+        if prefix:
+            placement = ['-I', '--prefix', prefix]
+        else:
+            placement = ['-U']
+        if not compile:
+            placement.append('--no-compile')
+        args = ['install'] + other_args + ['--no-deps'] + placement + [archive_path]
+        if python:
+            run_pip_in(python, args)
+        else:
+            run_pip(args)
+
+    def _archive_size(self):
+        """Return the size of the archive I downloaded or copied, or None if I
+        didn't need one."""
+        if '_downloaded_filename' in getattr(self, '_cache', {}) and not self._is_tree():
+            return os.path.getsize(join(self._temp_path, self._downloaded_filename()))
 
     @memoize
     def _actual_hash(self):
         """Download the package's archive if necessary, and return its hash."""
-        return hash_of_file(join(self._temp_path, self._downloaded_filename()))
+        path = join(self._temp_path, self._downloaded_filename())
+        # Copying or fetching it may have hashed it along the way:
+        known = getattr(self, '_cache', {}).get('_actual_hash')
+        if known:
+            return known
+        if self._is_tree():
+            return self._hash_tree(path)
+        return self._hash_file(path)
+
+    @timed('hash')
+    def _hash_file(self, path):
+        return hash_of_file(path)
+
+    @timed('hash')
+    def _hash_tree(self, path):
+        return tree_hash(path)
+
+    def _artifact_links(self):
+        """Return Links to the other archives the index offers for the version
+        I downloaded, like the wheels to go with an sdist.
+
+        Pip leaves out wheels it couldn't install here, so those for other
+        platforms and Pythons don't show up.
+
+        """
+        if self._link():
+            return []  # A URL requirement has only the one archive.
+        find_all = (getattr(self._finder, 'find_all_candidates', None) or  # 8.0
+                    getattr(self._finder, '_find_all_versions', None))  # 7.0
+        if find_all is None:
+            raise UnsupportedRequirementError(
+                '%s: --all-artifacts needs pip 7.0 or later.' % (self._req,))
+        version = str(parse_version(self._version()))
+        return [candidate.location for candidate in find_all(self._project_name())
+                if str(candidate.version) == version and
+                candidate.location.filename != self._downloaded_filename()]
+
+    @memoize  # Fetched during the parallel download pass, used after it
+    def _artifact_hashes(self):
+        """Return the hash of my archive followed by those of all the other
+        archives of the same version, downloading them as necessary."""
+        return [self._actual_hash()] + [
+            self._hash_file(join(self._temp_path, self._download(link)))
+            for link in self._artifact_links()]
 
     def _project_name(self):
         """Return the inner Requirement's "unsafe name".
@@ -686,7 +1950,13 @@ class DownloadedReq(object):
         return link.url if link else None
 
     @memoize  # Avoid re-running expensive check_if_exists().
+    @timed('check installed')
+    @measured('peep_check_installed_seconds')
     def _is_satisfied(self):
+        if self._fetch_only:
+            return False
+        if self._targets is not None:
+            return not self._targets
         self._req.check_if_exists()
         return (self._req.satisfied_by and
                 not self._is_always_unsatisfied())
@@ -697,6 +1967,8 @@ class DownloadedReq(object):
             self._project_name()
         except ValueError:
             return MalformedReq
+        if self._has_conflicting_hashes():
+            return ConflictingReq
         if self._is_satisfied():
             return SatisfiedReq
         if not self._expected_hashes():
@@ -713,6 +1985,24 @@ class DownloadedReq(object):
         """
         return ''
 
+    def result(self):
+        """Return a Result describing what became of me."""
+        path, line = path_and_line(self._req)
+        cache = getattr(self, '_cache', {})
+        return Result(
+            requirement=str(self._req.req or self._url()),
+            path=path,
+            line=line,
+            kind=self.__class__,
+            expected_hashes=self._expected_hashes(),
+            # Produce the hash for a MissingReq, since it's what you'd pin:
+            actual_hash=(self._actual_hash() if self.__class__ is MissingReq
+                         else cache.get('_actual_hash')),
+            archive_path=(join(self._temp_path, cache['_downloaded_filename'])
+                          if '_downloaded_filename' in cache else None),
+            timings=dict(self._timings),
+            message=self.error() if self.__class__ in ERROR_CLASSES else '')
+
 
 class MalformedReq(DownloadedReq):
     """A requirement whose package name could not be determined"""
@@ -725,6 +2015,27 @@ class MalformedReq(DownloadedReq):
         return '* Unable to determine package name from URL %s; add #egg=' % self._url()
 
 
+class ConflictingReq(DownloadedReq):
+    """A requirement which appears more than once, with hashes that don't
+    agree"""
+
+    @classmethod
+    def head(cls):
+        return ('The following requirements appear more than once in your requirements files, with\n'
+                'hashes that have none in common. Reconcile them:\n\n')
+
+    def error(self):
+        lines = ['    %s:' % (self._req.req,)]
+        for req, hashes in zip([self._req] + self._duplicates, self._hashes_by_req()):
+            lines.append('        %s line %s: %s' % (path_and_line(req) +
+                                                     (', '.join(hashes) or 'no hashes',)))
+        return '\n'.join(lines)
+
+    @classmethod
+    def foot(cls):
+        return '\n'
+
+
 class MissingReq(DownloadedReq):
     """A requirement for which no hashes were specified in the requirements file"""
 
@@ -741,7 +2052,7 @@ class MissingReq(DownloadedReq):
             line = self._url()
         else:
             line = '%s==%s' % (self._name(), self._version())
-        return '# sha256: %s\n%s\n' % (self._actual_hash(), line)
+        return '%s\n%s\n' % (self._hash_comment(self._actual_hash()), line)
 
 
 class MismatchedReq(DownloadedReq):
@@ -787,7 +2098,105 @@ class InstallableReq(DownloadedReq):
 # DownloadedReq subclasses that indicate an error that should keep us from
 # going forward with installation, in the order in which their errors should
 # be reported:
-ERROR_CLASSES = [MismatchedReq, MissingReq, MalformedReq]
+ERROR_CLASSES = [MismatchedReq, ConflictingReq, MissingReq, MalformedReq]
+
+
+class Result(object):
+    """The outcome of verifying one requirement, as returned by ``verify()``
+    and ``install()``
+
+    :attr requirement: The requirement, as a string
+    :attr path: The requirements file it came from
+    :attr line: The line of the file it came from, as pip counts them
+    :attr kind: The DownloadedReq subclass it turned out to be:
+        InstallableReq, SatisfiedReq, or one of the ``ERROR_CLASSES``
+    :attr ok: Whether it's fit to install (or already installed)
+    :attr expected_hashes: The hashes listed for it
+    :attr actual_hash: The hash of its archive, or None if it didn't need to
+        be downloaded
+    :attr archive_path: Where its archive was downloaded, or None. The
+        archive is gone after ``install()`` and after ``verify()`` unless you
+        ask it to keep archives.
+    :attr timings: A map of activity name ("download", "hash", "check
+        installed") to seconds spent on it
+    :attr message: What went wrong, for the error kinds, as ``peep install``
+        would say it
+    :attr installed: Whether ``install()`` installed it just now
+
+    """
+    def __init__(self, **kwargs):
+        self.installed = False
+        self.__dict__.update(kwargs)
+        self.ok = self.kind in (InstallableReq, SatisfiedReq)
+
+    def __repr__(self):
+        return '<Result %s: %s>' % (self.requirement, self.kind.__name__)
+
+
+def _downloaded_reqs(requirement_paths, args):
+    """Return DownloadedReqs for the given requirements files, given
+    ``peep install``-style options."""
+    load_pip()
+    options, argv = peep_options(list(args))
+    METRICS.configure(options)
+    return downloaded_reqs_from_paths(list(requirement_paths), argv, options)
+
+
+def verify(requirement_paths, args=(), keep_archives=False):
+    """Download and verify the requirements in some requirements files, and
+    return a list of Results, in order. Install nothing.
+
+    This is the in-process equivalent of the verification half of ``peep
+    install`` and can be called as many times as you like in one process.
+    Unsupported requirements, unfindable packages, and failed downloads raise
+    the same exceptions they would within ``peep install``.
+
+    :arg requirement_paths: Paths of requirements files
+    :arg args: Other ``peep install`` options, like ``['--index-url', url,
+        '--jobs', '4']``
+    :arg keep_archives: If True, leave the downloaded archives where the
+        results' ``archive_path`` attributes say, for you to delete when done
+
+    """
+    reqs = _downloaded_reqs(requirement_paths, args)
+    try:
+        return [req.result() for req in reqs]
+    finally:
+        if not keep_archives:
+            for req in reqs:
+                req.dispose()
+        METRICS.export()
+
+
+def install(requirement_paths, args=()):
+    """Verify the requirements in some requirements files and, if they're
+    all fine, install them. Return a list of Results, in order.
+
+    Like ``peep install``, install nothing if anything fails verification;
+    check the results' ``ok`` attributes to find out. A failed installation
+    raises PipException. Otherwise, this raises what ``verify()`` does.
+
+    :arg requirement_paths: Paths of requirements files
+    :arg args: Other ``peep install`` options, like ``['--index-url', url]``
+
+    """
+    reqs = _downloaded_reqs(requirement_paths, args)
+    try:
+        results = [req.result() for req in reqs]
+        if all(result.ok for result in results):
+            installable = [req for req, result in zip(reqs, results)
+                           if result.kind is InstallableReq]
+            if installable and installable[0]._targets is not None:
+                install_into_targets(installable)
+            else:
+                install_here(installable)
+            for result in results:
+                result.installed = result.kind is InstallableReq
+        return results
+    finally:
+        for req in reqs:
+            req.dispose()
+        METRICS.export()
 
 
 def bucket(things, key):
@@ -798,6 +2207,271 @@ def bucket(things, key):
     return ret
 
 
+def init_pip_thread():
+    """Set up the thread-local state which pip's logging expects its main
+    thread to have set up, so pip can be called from this thread."""
+    if pip is None:
+        return
+    try:
+        from pip.utils.logging import _log_state  # 6.0
+    except ImportError:
+        return
+    _log_state.indentation = 0
+
+
+def in_parallel(function, things, jobs):
+    """Return ``[function(t) for t in things]``, computed by up to ``jobs``
+    threads at once.
+
+    Work is started in the order of ``things``.
+
+    """
+    if jobs <= 1 or len(things) <= 1:
+        return [function(thing) for thing in things]
+    pool = ThreadPool(min(jobs, len(things)), initializer=init_pip_thread)
+    try:
+        return pool.map(function, things, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class HostSlots(object):
+    """A cap on how many downloads may be in flight to any one host at once,
+    so concurrent downloads don't hammer a single mirror
+
+    Use like ``with host_slots('example.com'): ...``.
+
+    """
+    def __init__(self, per_host):
+        self._per_host = per_host
+        self._lock = Lock()
+        self._semaphores = {}
+
+    def __call__(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = Semaphore(self._per_host)
+            return self._semaphores[host]
+
+
+class RateLimit(object):
+    """A token bucket shared by all the downloads of a run, holding their
+    combined rate to some number of bytes per second
+
+    Up to a second's worth can go by in a burst, after a lull.
+
+    """
+    def __init__(self, rate):
+        self._rate = float(rate)
+        self._tokens = self._rate
+        self._last = time()
+        self._lock = Lock()
+
+    def take(self, amount):
+        """Wait until ``amount`` more bytes may be transferred.
+
+        Each caller reserves its bytes straight away, going into debt if need
+        be, and then sleeps off its share of the debt outside the lock, so
+        concurrent downloads are served in turn.
+
+        """
+        with self._lock:
+            now = time()
+            self._tokens = min(self._rate,
+                               self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self._rate
+        if wait > 0:
+            sleep(wait)
+
+    def throttle(self, chunks):
+        """Pass through an iterable of chunks of bytes no faster than
+        allowed."""
+        for chunk in chunks:
+            self.take(len(chunk))
+            yield chunk
+
+
+class Progress(object):
+    """One display of how all a run's downloads in flight are coming along,
+    however many there are at once
+
+    On a terminal, it's a single status line, redrawn at most a few times a
+    second. Elsewhere, as on CI, it's a plain line logged every few seconds.
+    Either way, a 4K chunk costs only a bit of arithmetic, not a redraw.
+
+    """
+    def __init__(self, stream=None, interval=None):
+        """
+        :arg stream: Where to draw, stdout by default
+        :arg interval: The least number of seconds between updates
+
+        """
+        self._stream = stream or sys.stdout
+        self._is_tty = getattr(self._stream, 'isatty', lambda: False)()
+        self._interval = (interval if interval is not None
+                          else 0.25 if self._is_tty else 10)
+        self._lock = Lock()
+        self._downloads = {}  # key -> [bytes so far, expected size or 0]
+        self._next_key = 0
+        self._started = None
+        self._moved = 0  # bytes since then, finished downloads' included
+        self._last_update = time()
+        self._drawn = 0  # the length of the status line on the terminal
+
+    def note(self, text):
+        """Print a line of text without trampling the status line."""
+        with self._lock:
+            self._erase()
+            self._stream.write(text + '\n')
+            self._stream.flush()
+
+    def start(self, size):
+        """Start showing a download of ``size`` bytes (0 for unknown), and
+        return a key for advancing and finishing it."""
+        with self._lock:
+            key = self._next_key
+            self._next_key += 1
+            self._downloads[key] = [0, size]
+            if self._started is None:
+                self._started = time()
+            return key
+
+    def advance(self, key, amount):
+        """Count ``amount`` more bytes of a download. Safe to call from any
+        thread."""
+        with self._lock:
+            self._downloads[key][0] += amount
+            self._moved += amount
+            now = time()
+            if now - self._last_update >= self._interval:
+                self._last_update = now
+                self._update(now)
+
+    def finish(self, key):
+        """Stop showing a download, clearing the display once there are no
+        more."""
+        with self._lock:
+            del self._downloads[key]
+            if not self._downloads:
+                self._erase()
+                self._started = None
+                self._moved = 0
+
+    def track(self, chunks, size):
+        """Pass through an iterable of chunks of a download, counting them.
+
+        :arg size: The expected size of the download, or 0 if unknown
+
+        """
+        key = self.start(size)
+        try:
+            for chunk in chunks:
+                self.advance(key, len(chunk))
+                yield chunk
+        finally:
+            self.finish(key)
+
+    def _update(self, now):
+        """Show the totals of the downloads in flight."""
+        done = sum(d for d, _ in self._downloads.values())
+        sizes = [size for _, size in self._downloads.values()]
+        rate = self._moved / max(now - self._started, 0.001)
+        line = '%s download%s: %s%s at %s/s' % (
+            len(sizes),
+            '' if len(sizes) == 1 else 's',
+            format_size(done),
+            (' of %s (%d%%)' % (format_size(sum(sizes)), 100 * done // sum(sizes)))
+            if all(sizes) else '',
+            format_size(rate))
+        if self._is_tty:
+            line = line[:79]
+            self._stream.write('\r' + line.ljust(self._drawn))
+            self._drawn = len(line)
+        else:
+            self._stream.write(line + '\n')
+        self._stream.flush()
+
+    def _erase(self):
+        """Clear the status line, if there is one."""
+        if self._drawn:
+            self._stream.write('\r%s\r' % (' ' * self._drawn))
+            self._drawn = 0
+
+
+class HintFile(object):
+    """Values remembered between runs in a small JSON file, like archive
+    sizes for scheduling downloads
+
+    They're only hints, so a missing or garbled file is no trouble, and
+    concurrent runs are welcome to clobber each other's updates.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as file:
+                self._values = dict(json.load(file))
+        except (IOError, OSError, ValueError, TypeError):
+            self._values = {}
+
+    def get(self, key):
+        return self._values.get(key)
+
+    def update(self, values):
+        """Record some new values, given as a map, and save."""
+        self._values.update(values)
+        self._save()
+
+    def discard(self, keys):
+        """Forget the values of some keys, and save."""
+        for key in keys:
+            self._values.pop(key, None)
+        self._save()
+
+    def _save(self):
+        try:
+            makedirs(dirname(self.path))
+            temp_path = '%s.%s' % (self.path, os.getpid())
+            with open(temp_path, 'w') as file:
+                json.dump(self._values, file)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            pass  # Merely a missed optimization next time
+
+
+def describe(reqs, out):
+    """Pass to ``out`` the head, the error text of each, and the foot of a
+    list of DownloadedReqs of one class, or nothing if the list is empty."""
+    first_every_last(reqs,
+                     lambda r: out(r.head()),
+                     lambda r: out(r.error() + '\n'),
+                     lambda r: out(r.foot()))
+
+
+def described_errors(buckets, out, refusal, classes=ERROR_CLASSES):
+    """If any DownloadedReqs of the given error classes turned up, pass to
+    ``out`` a description of them, in order, and then what we're refusing to
+    do about it, and return True. Otherwise, return False.
+
+    :arg buckets: A map of DownloadedReq class -> list of DownloadedReqs
+    :arg refusal: A line like "Not proceeding to installation."
+
+    """
+    errors = [c for c in classes if buckets[c]]
+    if not errors:
+        return False
+    # Skip a line after pip's "Cleaning up..." so the important stuff
+    # stands out:
+    out('\n')
+    for c in errors:
+        describe(buckets[c], out)
+    out('-------------------------------\n%s\n' % refusal)
+    return True
+
+
 def first_every_last(iterable, first, every, last):
     """Execute something before the first item of iter, something else for each
     item, and a third thing after the last.
@@ -816,6 +2490,7 @@ def first_every_last(iterable, first, every, last):
 
 
 def _parse_requirements(path, finder):
+    refuse_hash_options_before_pip_8(path)
     try:
         # list() so the generator that is parse_requirements() actually runs
         # far enough to report a TypeError
@@ -831,63 +2506,711 @@ def _parse_requirements(path, finder):
             path, options=EmptyOptions(), session=PipSession(), finder=finder))
 
 
-def downloaded_reqs_from_path(path, argv):
+def refuse_hash_options_before_pip_8(path):
+    """Raise UnsupportedRequirementError if a requirements file, or one it
+    includes, has ``--hash`` options but pip is too old to parse them.
+
+    Before 8.0, pip dies of them with a traceback or a usage message.
+
+    """
+    try:
+        activate('pip>=8.0')
+    except RuntimeError:
+        try:
+            requirements = list(static_requirements(path, []))
+        except (IOError, OSError, UnicodeDecodeError):
+            return  # Let pip complain in its usual way.
+        for req_path, line, text, _ in requirements:
+            if HASH_OPTION_RE.search(text):
+                raise UnsupportedRequirementError(
+                    '%s line %s has --hash options, which pip understands only '
+                    'as of 8.0. Upgrade pip, or put the hashes in # sha256: '
+                    'comments instead.' % (req_path, line))
+
+
+def stable_hash(text):
+    """Return an integer hash of a string which, unlike ``hash()``, is the
+    same in every process and on every machine."""
+    return int(sha256(text.encode('utf-8')).hexdigest(), 16)
+
+
+def parse_shard(text):
+    """Turn an "i/N" shard spec into a 0-based shard index and a shard count.
+
+    Raise OptionError if it's malformed.
+
+    """
+    try:
+        index, count = [int(n) for n in text.split('/')]
+    except ValueError:
+        index = count = 0
+    if not 1 <= index <= count:
+        raise OptionError('--shard takes the form i/N, where 1 <= i <= N: for '
+                          'example, 2/3.')
+    return index - 1, count
+
+
+def shard_of(reqs, index, count):
+    """Return the requirements which shard number ``index`` of ``count``
+    should handle.
+
+    Every node computes the same division as long as it parses the same
+    requirements files. Requirements are dealt out largest first, by their
+    ``# size:`` hints, each to whichever shard has the least work so far, so
+    one shard doesn't get all the big archives. Requirements without a hint
+    count as the average hinted size. Ties are broken by a stable hash of the
+    project name.
+
+    :arg reqs: InstallRequirements
+
+    """
+    def name(req):
+        return (getattr(req.req, 'project_name', None) or
+                getattr(req, 'name', None) or
+                str(getattr(req, 'url', None) or req)).lower()
+
+    sizes = [size_above(*path_and_line(req)) for req in reqs]
+    known = [s for s in sizes if s is not None]
+    default = sum(known) // len(known) if known else 1
+    loads = [0] * count
+    mine = []
+    for req, size in sorted(zip(reqs, [default if s is None else s for s in sizes]),
+                            key=lambda pair: (-pair[1], stable_hash(name(pair[0])))):
+        lightest = loads.index(min(loads))
+        loads[lightest] += size
+        if lightest == index:
+            mine.append(req)
+    return mine
+
+
+def url_of(req):
+    """Return the URL an InstallRequirement came from, without any fragment,
+    or None if it came from an index."""
+    link = getattr(req, 'link', None)
+    url = link.url_without_fragment if link else getattr(req, 'url', None)
+    return url.split('#', 1)[0] if url else None
+
+
+def identity(req):
+    """Return a key which is the same for InstallRequirements that would
+    install the very same thing."""
+    return url_of(req) or re.sub(r'\s+', '', str(req.req)).lower()
+
+
+# Run by a target environment's interpreter to tell which of a JSON list of
+# requirement strings (or nulls) from stdin it already satisfies. This has to
+# work on any Python peep might be pointed at.
+SATISFIED_SCRIPT = """
+import json, sys
+import pkg_resources
+satisfied = []
+for i, spec in enumerate(json.loads(sys.stdin.read())):
+    try:
+        if spec:
+            pkg_resources.get_distribution(spec)
+            satisfied.append(i)
+    except Exception:
+        pass
+sys.stdout.write(json.dumps(satisfied))
+"""
+
+
+def target_python(target):
+    """Return the path of the interpreter of a ``--target-env``, which may be
+    given as the interpreter itself or as the environment's prefix dir."""
+    if isdir(target):
+        for candidate in [join(target, 'bin', 'python'),
+                          join(target, 'Scripts', 'python.exe')]:
+            if exists(candidate):
+                return candidate
+        raise OptionError("Couldn't find a Python interpreter in %s." % target)
+    return target
+
+
+def targets_needing(reqs, pythons):
+    """Return a map of ``id(req)`` -> list of the target interpreters which
+    don't yet have that InstallRequirement, querying them all at once.
+
+    """
+    specs = [None if url_is_always_unsatisfied(url_of(req)) or not req.req
+             else str(req.req)
+             for req in reqs]
+
+    def satisfied_in(python):
+        process = Popen([python, '-c', SATISFIED_SCRIPT], stdin=PIPE, stdout=PIPE)
+        output, _ = process.communicate(json.dumps(specs).encode('utf-8'))
+        if process.returncode:
+            raise OptionError("Couldn't ask %s what it has installed." % python)
+        return set(json.loads(output.decode('utf-8')))
+
+    satisfied = dict(zip(pythons, in_parallel(satisfied_in, pythons, len(pythons))))
+    return dict((id(req), [p for p in pythons if i not in satisfied[p]])
+                for i, req in enumerate(reqs))
+
+
+def install_into_targets(reqs):
+    """Install verified DownloadedReqs into whichever target environments
+    need them, working on all the targets at once."""
+    by_target = defaultdict(list)
+    for req in reqs:
+        for python in req._targets:
+            by_target[python].append(req)
+
+    def install_all(python):
+        for req in by_target[python]:
+            req.install(python=python)
+
+    in_parallel(install_all, list(by_target), len(by_target))
+
+
+def install_here(reqs):
+    """Install verified DownloadedReqs into our own environment, and compile
+    the Python files they bring to bytecode in one parallel pass at the end,
+    rather than one at a time as pip would.
+
+    If pip is told ``--compile`` or ``--no-compile``, it's left to do as
+    told. So it is if told to put things somewhere else, like with
+    ``--target`` or ``--user``, since we find the files to compile on our
+    own ``sys.path``.
+
+    """
+    if not reqs:
+        return
+    other_args = list(requirement_args(reqs[0]._argv, want_other=True))
+    parser = loads(_install_command()[1])
+    pip_options, _ = parser.parse_args(other_args)
+    placed_elsewhere = any(getattr(pip_options, dest, None) for dest in
+                           ['target_dir', 'prefix_path', 'root_path',
+                            'use_user_site', 'install_options'])
+    defer = ('--compile' not in other_args and '--no-compile' not in other_args and
+             not placed_elsewhere and
+             parser.has_option('--no-compile'))  # pip 1.5
+    for req in reqs:
+        req.install(compile=not defer)
+    if defer:
+        paths = installed_python_files([req._project_name() for req in reqs])
+        for path, error in compile_in_parallel(paths, reqs[0]._optimization_levels):
+            print("Couldn't compile %s: %s" % (path, error))
+
+
+def installed_python_files(project_names):
+    """Return the paths of the .py files the installed distributions of some
+    projects own, going by their RECORDs or, for ones setup.py installed,
+    their installed-files.txt lists."""
+    dists = dict((dist.key, dist) for dist in WorkingSet())  # fresh from disk
+    paths = []
+    for name in project_names:
+        dist = dists.get(safe_name(name).lower())
+        if dist is None:
+            continue
+        files = installed_files(dist)
+        if files is None and dist.has_metadata('installed-files.txt'):
+            egg_info = join(dist.location, dist.egg_name() + '.egg-info')
+            files = [normpath(join(egg_info, line))
+                     for line in dist.get_metadata_lines('installed-files.txt')]
+        paths.extend(path for path in files or [] if path.endswith('.py'))
+    return paths
+
+
+def _compile(path_and_level):
+    """Compile a Python file to bytecode at an optimization level, and return
+    (path, error message or None). Run in a compiling worker process."""
+    path, level = path_and_level
+    try:
+        if sys.version_info < (3, 2):
+            py_compile.compile(path, doraise=True)
+        else:
+            py_compile.compile(path, doraise=True, optimize=level)
+    except py_compile.PyCompileError as exc:
+        return path, exc.msg.strip()
+    except (IOError, OSError) as exc:
+        return path, str(exc)
+    return path, None
+
+
+@measured('peep_compile_seconds')
+def compile_in_parallel(paths, levels):
+    """Compile Python files to bytecode at each of some optimization levels,
+    across a pool of processes, and return (path, error message) for each
+    one that failed."""
+    work = [(path, level) for path in paths for level in levels]
+    if not work:
+        return []
+    pool = Pool(min(cpu_count(), len(work)))
+    try:
+        results = pool.map(_compile, work, chunksize=64)
+    finally:
+        pool.close()
+        pool.join()
+    return [(path, error) for path, error in results if error]
+
+
+def downloaded_reqs_from_paths(paths, argv, options, wanted=None):
+    """Return a list of DownloadedReqs representing the requirements parsed
+    out of some requirements files, narrowed to one ``--shard`` if asked.
+
+    One PackageFinder serves all the files, just as it would if pip were
+    handed them all at once. A requirement that shows up in more than one
+    place is downloaded and verified only once, against the hashes from all
+    of them.
+
+    :arg paths: The paths to the requirements files
+    :arg argv: The commandline args, starting after the subcommand
+    :arg options: peep's own options, as from ``peep_options()``
+    :arg wanted: A function which, given the list of InstallRequirements
+        asking for one thing, returns whether to download it at all. None
+        means all of them.
+
+    """
+    finder = package_finder(argv)
+    groups = {}
+    firsts = []
+    for req in chain.from_iterable(_parse_requirements(path, finder)
+                                   for path in paths):
+        group = groups.setdefault(identity(req), [])
+        if not group:
+            firsts.append(req)
+        group.append(req)
+    if options.shard:
+        mine = set(id(req) for req in
+                   shard_of(firsts, *parse_shard(options.shard)))
+        firsts = [req for req in firsts if id(req) in mine]
+    if wanted:
+        firsts = [req for req in firsts if wanted(groups[identity(req)])]
+
+    options.progress = Progress()
+    try:
+        options.optimization_levels = sorted(set(
+            int(level) for level in options.compile_levels.split(',')
+            if int(level) in (0, 1, 2)))
+    except ValueError:
+        options.optimization_levels = []
+    if not options.optimization_levels:
+        raise OptionError('--compile-levels takes optimization levels (0, 1, '
+                          'or 2) separated by commas, like 0,1.')
+    if options.optimization_levels != [0] and sys.version_info < (3, 2):
+        raise OptionError('Compiling at optimization levels other than 0 needs '
+                          'Python 3.2 or later.')
+    if options.limit_rate:
+        try:
+            options.rate_limit = RateLimit(parse_size(options.limit_rate))
+        except ValueError:
+            raise OptionError('--limit-rate takes a number of bytes per second, '
+                              'like 500K or 2M.')
+    try:
+        options.segment_threshold = parse_size(options.segment_above)
+    except ValueError:
+        raise OptionError('--segment-above takes a size, like 64M.')
+    if options.max_per_host < 1:
+        raise OptionError('--max-per-host takes a number of connections, 1 or more.')
+
+    needs = {}
+    if options.target_envs:
+        needs = targets_needing(firsts, [target_python(t) for t in options.target_envs])
+
+    options.host_slots = HostSlots(options.max_per_host)
+
+    def download(req):
+        downloaded = DownloadedReq(req, argv, finder, options=options,
+                                   duplicates=groups[identity(req)][1:],
+                                   targets=needs.get(id(req)))
+        # Fetch the other archives of the version in the same job, so they
+        # overlap with everything else's downloads rather than trailing them:
+        if options.all_artifacts and downloaded.__class__ in (InstallableReq, MissingReq):
+            downloaded._artifact_hashes()
+        return downloaded
+
+    if options.jobs <= 1:
+        return [download(req) for req in firsts]
+
+    # Start the biggest downloads first, lest a huge one started last
+    # determine the total time. Small ones fill in around them. Or, with
+    # --small-first, get as many done as soon as possible.
+    stats = HintFile(options.size_stats)
+    sizes = dict((id(req), size_above(*path_and_line(req)) or stats.get(identity(req)))
+                 for req in firsts)
+    known = [s for s in sizes.values() if s]
+    default = sum(known) // len(known) if known else 0
+    order = 1 if options.small_first else -1
+    scheduled = sorted(firsts, key=lambda req: order * (sizes[id(req)] or default))
+    downloaded = dict(zip([id(req) for req in scheduled],
+                          in_parallel(download, scheduled, options.jobs)))
+    stats.update(dict((identity(req), downloaded[id(req)]._archive_size())
+                      for req in firsts if downloaded[id(req)]._archive_size()))
+    return [downloaded[id(req)] for req in firsts]
+
+
+def downloaded_reqs_from_path(path, argv, options=None):
     """Return a list of DownloadedReqs representing the requirements parsed
     out of a given requirements file.
 
     :arg path: The path to the requirements file
     :arg argv: The commandline args, starting after the subcommand
+    :arg options: peep's own options, as from ``peep_options()``
 
     """
     finder = package_finder(argv)
-    return [DownloadedReq(req, argv, finder) for req in
+    return [DownloadedReq(req, argv, finder, options=options) for req in
             _parse_requirements(path, finder)]
 
 
-def peep_install(argv):
+def requirements_files(path):
+    """Yield the path of a requirements file and those of all the files it
+    includes, reading them without pip."""
+    yield path
+    with io.open(path, encoding='utf-8') as file:
+        for _, spanned in requirement_chunks(file):
+            included = spanned and included_path(path, joined_requirement(spanned)[0])
+            if included:
+                for included_file in requirements_files(included):
+                    yield included_file
+
+
+# Entries of a site-packages dir which change whenever what's installed does
+DIST_METADATA_ENDINGS = ('.dist-info', '.egg-info', '.egg', '.egg-link', '.pth')
+
+
+def install_fingerprint(argv, paths):
+    """Return a digest of everything the outcome of a ``peep install``
+    depends on, computed without pip: its args, the contents of the
+    requirements files, and the names and mtimes of the metadata of the
+    distributions installed here.
+
+    Raise IOError or OSError if a requirements file can't be read.
+
+    """
+    sha = sha256()
+    sha.update(json.dumps([__version__, sys.executable, argv]).encode('utf-8'))
+    for path in chain.from_iterable(requirements_files(p) for p in paths):
+        with open(path, 'rb') as file:
+            contents = file.read()
+        sha.update(('%s\0%s\0' % (path, len(contents))).encode('utf-8'))
+        sha.update(contents)
+    for dir in sys.path:
+        try:
+            names = sorted(os.listdir(dir or os.curdir))
+        except OSError:
+            continue
+        for name in names:
+            if name.endswith(DIST_METADATA_ENDINGS):
+                sha.update(('%s\0%s\0%r\0' % (
+                    dir, name, os.stat(join(dir, name)).st_mtime)).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def peep_install(argv, fetch_only=False):
     """Perform the ``peep install`` subcommand, returning a shell status code
     or raising a PipException.
 
     :arg argv: The commandline args, starting after the subcommand
+    :arg fetch_only: Just download and verify into the ``--store``, as for
+        ``peep fetch``, rather than installing
 
     """
+    original_argv = argv
+    options, argv = peep_options(argv)
+    if options.daemon:
+        return install_via_daemon(options.socket,
+                                  without_options(original_argv, ['--daemon', '--socket']))
+    if options.shard and not fetch_only:
+        raise OptionError('--shard works only with peep fetch. Installing part '
+                          'of your requirements would leave you with a broken '
+                          'environment.')
+    if fetch_only and not options.store:
+        raise OptionError('peep fetch needs a --store to fetch into.')
+    options.fetch_only = fetch_only
+    METRICS.configure(options)
+
+    # If neither the requirements nor the environment has changed since the
+    # last successful install, there's nothing to do, and pip needn't even
+    # be imported to find that out.
+    fingerprints = fingerprint = None
+    req_paths = requirement_paths(argv, NEED_HASHES)
+    if not fetch_only and not options.target_envs:
+        fingerprints = HintFile(options.fingerprints)
+        fingerprint_argv = without_options(original_argv, ['--force'])
+        try:
+            fingerprint = install_fingerprint(fingerprint_argv, req_paths)
+        except (IOError, OSError):
+            pass  # Let the install proper complain.
+        else:
+            if not options.force and fingerprints.get(sys.prefix) == fingerprint:
+                print('Nothing has changed since the last peep install. Use '
+                      '--force to check everything anyway.')
+                return ITS_FINE_ITS_FINE
+    load_pip()
+
     output = []
     out = output.append
     reqs = []
     try:
-        req_paths = list(requirement_args(argv, want_paths=True))
-        if not req_paths:
-            out("You have to specify one or more requirements files with the -r option, because\n"
-                "otherwise there's nowhere for peep to look up the hashes.\n")
-            return COMMAND_LINE_ERROR
-
         # We're a "peep install" command, and we have some requirement paths.
-        reqs = list(chain.from_iterable(
-            downloaded_reqs_from_path(path, argv)
-            for path in req_paths))
+        reqs = downloaded_reqs_from_paths(req_paths, argv, options)
         buckets = bucket(reqs, lambda r: r.__class__)
+        if described_errors(buckets, out, 'Not proceeding to installation.'):
+            return SOMETHING_WENT_WRONG
+        elif fetch_only:
+            out('Verified %s archives and stored them in %s.\n' %
+                (len(buckets[InstallableReq]), options.store))
+        else:
+            if options.target_envs:
+                install_into_targets(buckets[InstallableReq])
+            else:
+                install_here(buckets[InstallableReq])
+
+            describe(buckets[SatisfiedReq], out)
+            if fingerprint:
+                # Installing changed the environment, so fingerprint it anew:
+                fingerprints.update({sys.prefix: install_fingerprint(
+                    fingerprint_argv, req_paths)})
+
+        return ITS_FINE_ITS_FINE
+    except (UnsupportedRequirementError, InstallationError, DownloadError) as exc:
+        out(str(exc))
+        return SOMETHING_WENT_WRONG
+    finally:
+        for req in reqs:
+            req.dispose()
+        print(''.join(output))
+
+
+def peep_fetch(argv):
+    """Perform the ``peep fetch`` subcommand: download and verify
+    requirements into a ``--store``, installing nothing. Return a shell status
+    code.
+
+    With ``--shard i/N``, each of N machines can fetch its share of the
+    requirements into a shared store, after which ``peep install --store``
+    finds them all locally.
+
+    :arg argv: The commandline args, starting after the subcommand
+
+    """
+    return peep_install(argv, fetch_only=True)
+
+
+# Distributions peep sync leaves alone though no requirement names them,
+# since peep and pip need them to do anything at all
+SYNC_KEEPS = ['distribute', 'peep', 'pip', 'setuptools', 'wheel']
+
+
+def is_local(dist):
+    """Return whether an installed distribution lives in this environment,
+    rather than, say, a system site-packages a virtualenv can see."""
+    prefix = os.path.normcase(os.path.realpath(sys.prefix))
+    location = os.path.normcase(os.path.realpath(dist.location))
+    # Mind the separator, lest /venv claim /venv-other/lib/...:
+    return location == prefix or location.startswith(prefix.rstrip(os.sep) + os.sep)
 
-        # Skip a line after pip's "Cleaning up..." so the important stuff
-        # stands out:
-        if any(buckets[b] for b in ERROR_CLASSES):
-            out('\n')
 
-        printers = (lambda r: out(r.head()),
-                    lambda r: out(r.error() + '\n'),
-                    lambda r: out(r.foot()))
-        for c in ERROR_CLASSES:
-            first_every_last(buckets[c], *printers)
+def peep_sync(argv):
+    """Perform the ``peep sync`` subcommand: make this environment have just
+    what the requirements files say, and nothing else. Return a shell status
+    code.
+
+    Installed distributions are listed once, up front, and compared with the
+    requirements without downloading anything. Only requirements which
+    aren't already satisfied are downloaded and verified, and, once they all
+    pass, the rest are installed and then distributions nothing asks for are
+    uninstalled. With ``--dry-run``, just say what would change, downloading
+    nothing.
+
+    :arg argv: The commandline args, starting after the subcommand
+
+    """
+    dry_run = '--dry-run' in argv
+    options, argv = peep_options([arg for arg in argv if arg != '--dry-run'])
+    if options.daemon or options.shard or options.target_envs:
+        raise OptionError('peep sync works only on its own environment, all '
+                          'at once, so it takes no --daemon, --shard, or '
+                          '--target-env.')
+    req_paths = requirement_paths(argv, NEED_HASHES)
+    METRICS.configure(options)
+    load_pip()
+    installed = dict((dist.key, dist) for dist in WorkingSet())
+    named = set()
+    unchanged = []
+    changed = []
+
+    def is_changed(group):
+        req = group[0]
+        if req.name:
+            named.add(safe_name(req.name).lower())
+        if not url_is_always_unsatisfied(url_of(req)) and req.req:
+            dist = installed.get(safe_name(req.name).lower())
+            if dist is not None and dist in Requirement.parse(str(req.req)):
+                unchanged.append(req)
+                return False
+        changed.append(req)
+        return not dry_run
+
+    output = []
+    out = output.append
+    reqs = []
+    try:
+        reqs = downloaded_reqs_from_paths(req_paths, argv, options, wanted=is_changed)
+        removals = sorted(dist.project_name for key, dist in installed.items()
+                          if key not in named and key not in SYNC_KEEPS and
+                          is_local(dist))
+        if dry_run:
+            for req in changed:
+                out('Would %s %s.\n' % (
+                    'upgrade to' if req.name and safe_name(req.name).lower() in installed
+                    else 'install',
+                    req.req or url_of(req)))
+            for name in removals:
+                out('Would remove %s.\n' % name)
+            if not changed and not removals:
+                out('Everything is already in sync.\n')
+            return ITS_FINE_ITS_FINE
 
-        if any(buckets[b] for b in ERROR_CLASSES):
-            out('-------------------------------\n'
-                'Not proceeding to installation.\n')
+        buckets = bucket(reqs, lambda r: r.__class__)
+        if described_errors(buckets, out, 'Not changing the environment.'):
             return SOMETHING_WENT_WRONG
-        else:
-            for req in buckets[InstallableReq]:
-                req.install()
 
-            first_every_last(buckets[SatisfiedReq], *printers)
+        # Install first, so a failure leaves everything that was there:
+        install_here(buckets[InstallableReq])
+        if removals:
+            run_pip(['uninstall', '-y'] + removals)
+        upgraded = [r for r in buckets[InstallableReq]
+                    if safe_name(r._project_name()).lower() in installed]
+        out('Installed %s, upgraded %s, and removed %s distributions. %s were '
+            'already up to date.\n' %
+            (len(buckets[InstallableReq]) - len(upgraded), len(upgraded),
+             len(removals), len(unchanged) + len(buckets[SatisfiedReq])))
+        return ITS_FINE_ITS_FINE
+    except (UnsupportedRequirementError, InstallationError, DownloadError) as exc:
+        out(str(exc))
+        return SOMETHING_WENT_WRONG
+    finally:
+        for req in reqs:
+            req.dispose()
+        print(''.join(output))
+
 
+# The name of the manifest at the root of a bundle made by ``peep bundle``
+BUNDLE_MANIFEST = 'peep-bundle.json'
+
+
+def bundle_compression(path):
+    """Return how a bundle should be compressed, going by its filename: a
+    tarfile compression like "gz", "" for none, or "zst". Raise OptionError
+    if the name doesn't say."""
+    for ending, compression in [('.tar', ''), ('.tar.gz', 'gz'), ('.tgz', 'gz'),
+                                ('.tar.bz2', 'bz2'), ('.tar.xz', 'xz'),
+                                ('.tar.zst', 'zst')]:
+        if path.endswith(ending):
+            return compression
+    raise OptionError('A bundle should be named like env.tar.gz, env.tar.bz2, '
+                      'env.tar.xz, env.tar.zst, or env.tar.')
+
+
+def zstandard():
+    """Return the ``zstandard`` module, which only .zst bundles need. Raise
+    OptionError if it isn't installed."""
+    try:
+        import zstandard
+    except ImportError:
+        raise OptionError('.zst bundles need the zstandard module. Install it, '
+                          'or name the bundle .tar.gz instead.')
+    return zstandard
+
+
+def write_bundle(path, root, manifest):
+    """Pack the contents of a dir, plus a manifest, into a bundle, and return
+    the bundle's hash.
+
+    The bundle appears at ``path`` only once it's complete.
+
+    :arg root: The dir whose contents to pack
+    :arg manifest: A JSON-able dict to put at the bundle's root, as
+        ``BUNDLE_MANIFEST``
+
+    """
+    def pack(tar):
+        try:
+            data = json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8')
+            info = tarfile.TarInfo(BUNDLE_MANIFEST)
+            info.size = len(data)
+            info.mtime = int(time())
+            tar.addfile(info, io.BytesIO(data))
+            for name in sorted(os.listdir(root)):
+                tar.add(join(root, name), arcname=name)
+        finally:
+            tar.close()
+
+    compression = bundle_compression(path)
+    partial = path + '.part'
+    try:
+        with open(partial, 'wb') as file:
+            if compression == 'zst':
+                with zstandard().ZstdCompressor().stream_writer(file) as compressor:
+                    pack(tarfile.open(fileobj=compressor, mode='w|'))
+            else:
+                pack(tarfile.open(fileobj=file, mode='w|' + compression))
+    except tarfile.CompressionError as exc:
+        os.remove(partial)
+        raise OptionError("This Python can't write %s: %s" % (path, exc))
+    os.rename(partial, path)
+    return hash_of_file(path)
+
+
+def peep_bundle(argv):
+    """Perform the ``peep bundle`` subcommand: verify the requirements,
+    install them into an empty staging prefix, and pack that into one
+    archive, with a manifest of the hashes of what went in. Return a shell
+    status code.
+
+    Unpacking the bundle with ``peep unbundle`` then takes the place of a
+    ``peep install``, with no pip runs or builds.
+
+    :arg argv: The commandline args, starting after the subcommand
+
+    """
+    options, argv = peep_options(argv)
+    if not options.output:
+        raise OptionError('peep bundle needs an --output path, like env.tar.gz.')
+    if options.daemon or options.shard or options.target_envs:
+        raise OptionError('peep bundle takes no --daemon, --shard, or --target-env.')
+    bundle_compression(options.output)  # Complain about the name up front.
+    req_paths = requirement_paths(argv, NEED_HASHES)
+    try:
+        activate('pip>=8.0')  # for install --prefix
+    except RuntimeError:
+        raise OptionError('peep bundle needs pip 8.0 or later, to install into '
+                          'its staging prefix.')
+    # Everything goes in the bundle, whatever is installed here:
+    options.fetch_only = True
+    METRICS.configure(options)
+    load_pip()
+
+    output = []
+    out = output.append
+    reqs = []
+    try:
+        reqs = downloaded_reqs_from_paths(req_paths, argv, options)
+        buckets = bucket(reqs, lambda r: r.__class__)
+        if described_errors(buckets, out, 'Not making a bundle.'):
+            return SOMETHING_WENT_WRONG
+
+        staging = mkdtemp(prefix='peep-bundle-')
+        try:
+            for req in buckets[InstallableReq]:
+                req.install(prefix=staging)
+            manifest = {
+                'python': '%s.%s' % sys.version_info[:2],
+                'platform': sys.platform,
+                'requirements': [
+                    {'requirement': str(req._req.req or req._url()),
+                     'hash': req._actual_hash(),
+                     'tree': req._is_tree()}
+                    for req in buckets[InstallableReq]]}
+            hash = write_bundle(options.output, staging, manifest)
+        finally:
+            rmtree(staging, ignore_errors=True)
+        out('Bundled %s requirements into %s. To install them, run:\n\n'
+            '    peep unbundle %s --hash %s\n' %
+            (len(buckets[InstallableReq]), options.output, options.output, hash))
         return ITS_FINE_ITS_FINE
     except (UnsupportedRequirementError, InstallationError, DownloadError) as exc:
         out(str(exc))
@@ -898,53 +3221,1151 @@ def peep_install(argv):
         print(''.join(output))
 
 
-def peep_port(paths):
-    """Convert a peep requirements file to one compatble with pip-8 hashing.
+class HashingReader(object):
+    """A file-like wrapper which hashes everything read through it"""
+
+    def __init__(self, file):
+        self._file = file
+        self.sha = sha256()
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self.sha.update(data)
+        return data
+
+
+def is_safe_member(member):
+    """Return whether a tar member stays within the dir it's extracted to
+    and is something a bundle should hold: a file, dir, or link."""
+    def is_inside(path):
+        return not os.path.isabs(path) and '..' not in path.split('/')
+    if not (member.isfile() or member.isdir() or member.issym() or member.islnk()):
+        return False
+    if member.issym() or member.islnk():
+        linkname = (member.linkname if member.islnk() else
+                    posixpath.join(posixpath.dirname(member.name), member.linkname))
+        if not is_inside(linkname):
+            return False
+    return is_inside(member.name)
+
+
+def extract_bundle(path, dest):
+    """Unpack a bundle into a dir, reading it once, front to back, and
+    return the bundle's hash.
+
+    Raise tarfile.TarError if the bundle holds anything which would land
+    outside ``dest``.
+
+    """
+    with open(path, 'rb') as file:
+        reader = HashingReader(file)
+        if bundle_compression(path) == 'zst':
+            source = zstandard().ZstdDecompressor().stream_reader(reader)
+            tar = tarfile.open(fileobj=source, mode='r|')
+        else:
+            tar = tarfile.open(fileobj=reader, mode='r|*')
+        try:
+            for member in tar:
+                if not is_safe_member(member):
+                    raise tarfile.TarError('%s has an unsafe member: %s' %
+                                           (path, member.name))
+                tar.extract(member, dest)
+        finally:
+            tar.close()
+        # Hash any padding after the end of the archive as well:
+        while reader.read(2 ** 20):
+            pass
+    return encoded_hash(reader.sha)
+
+
+def peep_unbundle(argv):
+    """Perform the ``peep unbundle`` subcommand: check a bundle's hash, and
+    unpack it into an environment. Return a shell status code.
+
+    The bundle is read just once. It's unpacked into a staging dir inside the
+    environment while being hashed, and its files are moved into place only
+    if the hash matches.
+
+    :arg argv: The commandline args, starting after the subcommand
+
+    """
+    parser = OptionParser(
+        usage='usage: %prog unbundle BUNDLE --hash HASH [--prefix DIR]',
+        description='Install the contents of a bundle made by peep bundle, '
+                    'after making sure it has the hash peep bundle printed.')
+    parser.add_option('--hash', dest='hash',
+                      help='The hash the bundle must have')
+    parser.add_option('--prefix', dest='prefix', default=sys.prefix,
+                      help='The environment to unpack into, if not this one')
+    options, args = parser.parse_args(args=argv)
+    if len(args) != 1 or not options.hash:
+        parser.print_usage()
+        return COMMAND_LINE_ERROR
+    path = args[0]
+
+    makedirs(options.prefix)
+    # Staging in the environment keeps it on the same filesystem, so the
+    # files can be moved into place without copying.
+    staging = mkdtemp(prefix='.peep-unbundle-', dir=options.prefix)
+    try:
+        try:
+            actual = extract_bundle(path, staging)
+        except (tarfile.TarError, IOError, EOFError) as exc:
+            print("Couldn't unpack %s: %s" % (path, exc))
+            return SOMETHING_WENT_WRONG
+        if actual != options.hash:
+            print('%s has the hash %s, not %s. Not unpacking it.' %
+                  (path, actual, options.hash))
+            return SOMETHING_WENT_WRONG
+        with open(join(staging, BUNDLE_MANIFEST)) as file:
+            manifest = json.load(file)
+        python = '%s.%s' % sys.version_info[:2]
+        if options.prefix == sys.prefix and manifest['python'] != python:
+            print('%s was made for Python %s, not %s. Not unpacking it.' %
+                  (path, manifest['python'], python))
+            return SOMETHING_WENT_WRONG
+        os.remove(join(staging, BUNDLE_MANIFEST))
+        for dir, dirs, files in os.walk(staging):
+            dest_dir = join(options.prefix, os.path.relpath(dir, staging))
+            makedirs(dest_dir)
+            for name in files + [d for d in dirs if os.path.islink(join(dir, d))]:
+                os.rename(join(dir, name), join(dest_dir, name))
+        print('Unpacked %s requirements into %s.' %
+              (len(manifest['requirements']), options.prefix))
+        return ITS_FINE_ITS_FINE
+    finally:
+        rmtree(staging, ignore_errors=True)
+
+
+def cache_verify(argv):
+    """Perform the ``peep cache verify`` subcommand: rehash the archives in a
+    store, and quarantine any which no longer match the hashes they're
+    filed under. Return a shell status code.
+
+    When each archive last passed is remembered in the store, so frequent
+    runs rehash only the ones not checked lately.
+
+    :arg argv: The commandline args, starting after ``verify``
+
+    """
+    parser = OptionParser(
+        usage='usage: %prog cache verify --store DIR [options]',
+        description='Rehash the archives in a peep store, and move any that '
+                    "don't match their hashes into its .quarantine dir.")
+    parser.add_option('--store', help='The store to check')
+    parser.add_option('--jobs', type='int', default=cpu_count(),
+                      help='Archives to hash at once. Default: %default')
+    parser.add_option('--limit-rate', metavar='SIZE',
+                      help='Read no more than this many bytes per second, '
+                           'like 50M, all jobs together.')
+    parser.add_option('--max-age', type='float', default=7, metavar='DAYS',
+                      help='Rehash archives not checked in this many days. '
+                           '0 rehashes everything. Default: %default')
+    options, _ = parser.parse_args(args=argv)
+    if not options.store:
+        parser.print_usage()
+        return COMMAND_LINE_ERROR
+    rate_limit = None
+    if options.limit_rate:
+        try:
+            rate_limit = RateLimit(parse_size(options.limit_rate))
+        except ValueError:
+            raise OptionError('--limit-rate takes a number of bytes per second, '
+                              'like 50M.')
+
+    store = ArchiveStore(options.store)
+    verified = HintFile(join(options.store, '.verified.json'))
+    now = time()
+    hashes = store.hashes()
+    # Oldest first, so an interrupted scrub makes headway next time:
+    due = sorted((h for h in hashes
+                  if now - (verified.get(h) or 0) >= options.max_age * 86400),
+                 key=lambda h: verified.get(h) or 0)
+
+    def is_intact(hash):
+        path = store.path(hash)
+        try:
+            return path is not None and hash_of_file(path, rate_limit) == hash
+        except (IOError, OSError):
+            return False
+
+    intact = in_parallel(is_intact, due, options.jobs)
+    verified.update(dict((h, now) for h, ok in zip(due, intact) if ok))
+    bad = [h for h, ok in zip(due, intact) if not ok]
+    # Lest an archive fetched anew under a damaged one's hash inherit its
+    # verification date:
+    verified.discard(bad)
+    for hash in bad:
+        try:
+            print("%s doesn't match its hash. Quarantined it in %s." %
+                  (hash, store.quarantine(hash)))
+        except OSError as exc:
+            print("%s doesn't match its hash, but it couldn't be quarantined: %s" %
+                  (hash, exc))
+    print('Rehashed %s of the %s archives in %s. %s were damaged.' %
+          (len(due), len(hashes), options.store, len(bad)))
+    return SOMETHING_WENT_WRONG if bad else ITS_FINE_ITS_FINE
+
+
+def peep_cache(argv):
+    """Perform the ``peep cache`` subcommand, which has subcommands of its
+    own, for looking after a ``--store``. Return a shell status code.
+
+    :arg argv: The commandline args, starting after the subcommand
+
+    """
+    commands = {'verify': cache_verify}
+    if not argv or argv[0] not in commands:
+        print('usage: peep cache verify --store DIR [options]')
+        return COMMAND_LINE_ERROR
+    return commands[argv[0]](argv[1:])
+
+
+def line_index(lines, line_number):
+    """Return the index within a requirements file's ``lines`` of the line
+    pip calls ``line_number``, whether or not this pip counts comments."""
+    if PIP_COUNTS_COMMENTS:
+        return line_number - 1
+    return [i for i, line in enumerate(lines)
+            if not IGNORED_LINE_RE.match(line)][line_number - 1]
+
+
+def insert_hashes(path, comments_by_line):
+    """Add hash comments to a requirements file, just above the lines they
+    pin, leaving everything else as it was.
+
+    :arg comments_by_line: A map of line number, as pip counts them, -> list
+        of comments, like "# sha256: ...", to add above that line
+
+    """
+    with io.open(path, encoding='utf-8', newline='') as file:
+        lines = file.readlines()
+    for line_number in sorted(comments_by_line, reverse=True):
+        index = line_index(lines, line_number)
+        line = lines[index]
+        indent = line[:len(line) - len(line.lstrip())]
+        ending = line[len(line.rstrip('\r\n')):] or '\n'
+        lines[index:index] = [indent + comment + ending
+                              for comment in comments_by_line[line_number]]
+    replace_file(path, lines)
+
+
+def has_hashes(req):
+    """Return whether any hashes are pinned above an InstallRequirement's
+    line."""
+    path, line = path_and_line(req)
+    return hashes_above(path, line) or tree_hashes_above(path, line)
+
+
+def lock_hashes(req_paths, argv, options, wanted, out):
+    """Download some requirements, all at once, and write their hashes into
+    the requirements files above the lines that lack them. Return a shell
+    status code.
+
+    :arg wanted: A function which, given the list of InstallRequirements
+        asking for one thing, returns whether to download it and pin it
+
+    """
+    reqs = []
+    try:
+        reqs = downloaded_reqs_from_paths(req_paths, argv, options, wanted=wanted)
+        # A MissingReq is what we're here for. An InstallableReq has hashes on
+        # some of its lines, which its download matched, so the rest can
+        # have its hash as well.
+        buckets = bucket(reqs, lambda r: r.__class__)
+        if described_errors(buckets, out, 'Not changing any requirements files.',
+                            [c for c in ERROR_CLASSES if c is not MissingReq]):
+            return SOMETHING_WENT_WRONG
+
+        additions = defaultdict(dict)
+        for req in reqs:
+            hashes = (req._artifact_hashes() if options.all_artifacts
+                      else [req._actual_hash()])
+            for line_req in [req._req] + req._duplicates:
+                if not has_hashes(line_req):
+                    path, line = path_and_line(line_req)
+                    additions[path][line] = [req._hash_comment(h) for h in hashes]
+        for path, comments_by_line in additions.items():
+            insert_hashes(path, comments_by_line)
+            out('Added hashes for %s requirements to %s.\n' % (len(comments_by_line), path))
+        if not additions:
+            out('Every requirement already has hashes.\n')
+        return ITS_FINE_ITS_FINE
+    finally:
+        for req in reqs:
+            req.dispose()
+
+
+def peep_lock(argv):
+    """Perform the ``peep lock`` subcommand: download the requirements that
+    have no hashes, all at once, and write their hashes into the requirements
+    files above them. Return a shell status code.
+
+    With ``--all-artifacts``, pin every archive offered for each version--the
+    sdist and the wheels--rather than just the one pip would pick here.
+
+    :arg argv: The commandline args, starting after the subcommand
+
+    """
+    # Downloads mostly wait on the network, so overlap plenty of them:
+    options, argv = peep_options(argv, jobs=8)
+    req_paths = requirement_paths(argv, 'so I\nknow which ones to add hashes to.')
+    # Download even what's already installed, since it's the hash we want:
+    options.fetch_only = True
+    METRICS.configure(options)
+    load_pip()
+
+    def lacks_hashes(group):
+        return not all(has_hashes(req) for req in group)
+
+    output = []
+    out = output.append
+    try:
+        return lock_hashes(req_paths, argv, options, lacks_hashes, out)
+    except (UnsupportedRequirementError, InstallationError, DownloadError) as exc:
+        out(str(exc))
+        return SOMETHING_WENT_WRONG
+    finally:
+        print(''.join(output))
+
+
+def pinned_version(text):
+    """Return the project key and version a requirement's text pins with
+    ``==``, or None if it isn't so pinned."""
+    spec, url = requirement_spec(text)
+    if url or text.startswith('-'):
+        return None
+    try:
+        requirement = Requirement.parse(spec)
+    except ValueError:
+        return None
+    if len(requirement.specs) != 1 or requirement.specs[0][0] != '==':
+        return None
+    return requirement.key, requirement.specs[0][1]
+
+
+def newest_version(finder, name, current):
+    """Return the newest version of a project the finder can find, or None.
+
+    Prereleases count only if pip was told ``--pre`` or the current version
+    is itself one.
+
+    """
+    find_all = (getattr(finder, 'find_all_candidates', None) or  # 8.0
+                getattr(finder, '_find_all_versions', None))  # 7.0
+    if find_all is None:
+        raise UnsupportedRequirementError('peep upgrade needs pip 7.0 or later.')
+
+    def is_prerelease(version):
+        return getattr(version, 'is_prerelease', False)  # setuptools >= 8
+
+    pre = (getattr(finder, 'allow_all_prereleases', False) or
+           is_prerelease(parse_version(current)))
+    versions = [parse_version(str(c.version)) for c in find_all(name)]
+    versions = [v for v in versions if pre or not is_prerelease(v)]
+    return str(max(versions)) if versions else None
+
+
+def without_hash_options(spanned):
+    """Return the lines a requirement spans with any pip 8 ``--hash`` options
+    taken out, dropping lines left holding nothing but a continuation."""
+    lines = [HASH_OPTION_RE.sub('', line) for line in spanned]
+    lines = [line for line in lines if line.strip() not in ('', '\\')] or lines[:1]
+    last = lines[-1].rstrip('\r\n')
+    if last.endswith('\\'):
+        lines[-1] = last.rstrip('\\').rstrip() + (spanned[-1][len(spanned[-1].rstrip('\r\n')):] or '\n')
+    return lines
+
+
+def upgraded_lines(path, bumps):
+    """Yield the lines of a requirements file with the versions of some
+    pinned projects changed and their hashes, above them or in ``--hash``
+    options, taken away, leaving everything else as it was.
+
+    :arg bumps: A map of project key -> (old version, new version)
+
+    """
+    with io.open(path, encoding='utf-8', newline='') as file:
+        for comments, spanned in requirement_chunks(file):
+            pin = pinned_version(joined_requirement(spanned)[0]) if spanned else None
+            if pin and pin[0] in bumps and pin[1] == bumps[pin[0]][0]:
+                old, new = bumps[pin[0]]
+                pattern = re.compile(r'(==\s*)%s(?![\w.])' % re.escape(old))
+                comments = [line for line in comments if not HASH_COMMENT_RE.match(line)]
+                spanned = without_hash_options(spanned)
+                changed = False
+                for i, line in enumerate(spanned):
+                    if not changed and pattern.search(line):
+                        spanned[i] = pattern.sub(r'\g<1>%s' % new, line, 1)
+                        changed = True
+            for line in comments + spanned:
+                yield line
+
+
+def peep_upgrade(argv):
+    """Perform the ``peep upgrade`` subcommand: find newer versions of the
+    pinned requirements, repin them, and write the hashes of the new versions
+    in place of the old. Return a shell status code.
+
+    The index is asked about every project at once, and the new versions are
+    downloaded at once, as for ``peep lock``. If any can't be downloaded and
+    verified, the requirements files are put back as they were.
+
+    With ``--only name,name``, upgrade just those projects.
+
+    :arg argv: The commandline args, starting after the subcommand
+
+    """
+    options, argv = peep_options(argv, jobs=8)
+    req_paths = requirement_paths(argv, 'so I\nknow which ones to upgrade.')
+    options.fetch_only = True
+    METRICS.configure(options)
+    load_pip()
+    only = set(safe_name(name.strip()).lower()
+               for name in (options.only or '').split(',') if name.strip())
+
+    output = []
+    out = output.append
+    originals = {}
+    try:
+
+        # Let any index options in the files reach the finder:
+        finder = package_finder(argv)
+        for path in req_paths:
+            list(_parse_requirements(path, finder))
+
+        paths = []
+        pins = {}
+        for path, _, text, _ in chain.from_iterable(static_requirements(p)
+                                                    for p in req_paths):
+            if path not in paths:
+                paths.append(path)
+            pin = pinned_version(text)
+            if pin and (not only or pin[0] in only):
+                pins.setdefault(pin[0], pin[1])
+        names = sorted(pins)
+        newest = in_parallel(lambda name: newest_version(finder, name, pins[name]),
+                             names, options.jobs)
+        bumps = dict((name, (pins[name], new)) for name, new in zip(names, newest)
+                     if new and parse_version(new) > parse_version(pins[name]))
+        if not bumps:
+            out('Everything is up to date.\n')
+            return ITS_FINE_ITS_FINE
+
+        for path in paths:
+            with io.open(path, encoding='utf-8', newline='') as file:
+                originals[path] = file.read()
+            replace_file(path, list(upgraded_lines(path, bumps)))
+
+        def is_bumped(group):
+            pin = pinned_version(str(group[0].req)) if group[0].req else None
+            return bool(pin) and pin[0] in bumps and pin[1] == bumps[pin[0]][1]
+
+        status = lock_hashes(req_paths, argv, options, is_bumped, out)
+        if status == ITS_FINE_ITS_FINE:
+            for name in names:
+                if name in bumps:
+                    out('Upgraded %s from %s to %s.\n' % ((name,) + bumps[name]))
+            originals = {}
+        return status
+    except (UnsupportedRequirementError, InstallationError, DownloadError) as exc:
+        out(str(exc))
+        return SOMETHING_WENT_WRONG
+    finally:
+        for path, text in originals.items():
+            replace_file(path, [text])
+        print(''.join(output))
+
+
+def installed_files(dist):
+    """Return a map of absolute path -> expected hash (or None) of the files
+    an installed distribution's RECORD lists, or None if it has no RECORD.
+
+    Only wheel-style installs (dist-info dirs) have RECORDs. Their hashes are
+    in the same encoding as peep's, prefixed with "sha256=".
+
+    """
+    if not dist.has_metadata('RECORD'):
+        return None
+    files = {}
+    for row in csv.reader(dist.get_metadata_lines('RECORD')):
+        if not row:
+            continue
+        path = normpath(join(dist.location, row[0]))
+        hash = row[1] if len(row) > 1 else ''
+        files[path] = hash[len('sha256='):] if hash.startswith('sha256=') else None
+    return files
+
+
+def _stat_and_hash(path):
+    """Return (path, size, mtime, hash) for a file, or (path, None, None,
+    None) if it's gone. Run in an audit worker process."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path, None, None, None
+    return path, stat.st_size, stat.st_mtime, mapped_hash_of_file(path)
+
+
+def unexpected_files(dist, files, owned):
+    """Yield files in the package dirs of an installed distribution which no
+    installed distribution's RECORD accounts for.
 
-    Loses comments and tromps on URLs, so the result will need a little manual
-    massaging, but the hard part--the hash conversion--is done for you.
+    :arg files: The paths listed in the dist's RECORD
+    :arg owned: The paths listed in anybody's RECORD
+
+    """
+    top_dirs = set()
+    for path in files:
+        if not path.startswith(dist.location + sep):
+            continue  # a script or some such, outside site-packages
+        parts = path[len(dist.location) + 1:].split(sep)
+        if len(parts) > 1 and not parts[0].endswith(('.dist-info', '.egg-info')):
+            top_dirs.add(join(dist.location, parts[0]))
+    for top in sorted(top_dirs):
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames[:] = [d for d in dirnames if d != '__pycache__']
+            for filename in filenames:
+                path = join(dirpath, filename)
+                if path not in owned and not filename.endswith(('.pyc', '.pyo')):
+                    yield path
+
+
+def peep_audit(argv):
+    """Check that the installed distributions still match the hashes in their
+    RECORDs and, optionally, the versions in some requirements files. Return
+    a shell status code.
+
+    Files are hashed across a pool of processes. Files whose size and mtime
+    haven't changed since the last audit are taken on faith, unless you say
+    ``--full``.
+
+    :arg argv: The commandline args, starting after the subcommand
 
     """
+    parser = OptionParser(
+        usage='usage: %prog audit [options]',
+        description='Report installed files which were modified, are '
+                    'missing, or are unaccounted for, according to the '
+                    'RECORDs of the installed distributions.')
+    parser.add_option('-r', '--requirement', dest='requirements', action='append',
+                      default=[], metavar='PATH',
+                      help='Also check installed versions against a requirements file.')
+    parser.add_option('--jobs', type='int', default=cpu_count(),
+                      help='Processes to hash with. Default: %default')
+    parser.add_option('--cache', default=join(PEEP_DIR, 'audit-%s.json' %
+                                              (stable_hash(sys.prefix) % 10 ** 8)),
+                      help='Where to remember hashes between audits. Default: %default')
+    parser.add_option('--full', action='store_true', default=False,
+                      help='Rehash everything, trusting no remembered hashes.')
+    options, _ = parser.parse_args(args=argv)
+
+    dists = sorted(WorkingSet(), key=lambda d: d.project_name.lower())
+    records = dict((dist, installed_files(dist)) for dist in dists)
+    owned = set()
+    for files in records.values():
+        owned.update(files or ())
+
+    cache = HintFile(options.cache)
+    to_hash = []
+    remembered = {}
+    for path in owned:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            remembered[path] = None  # missing
+            continue
+        known = None if options.full else cache.get(path)
+        if known and known[:2] == [stat.st_size, stat.st_mtime]:
+            remembered[path] = known[2]
+        else:
+            to_hash.append(path)
+    hashed = []
+    if to_hash:
+        pool = Pool(max(options.jobs, 1))
+        try:
+            hashed = pool.map(_stat_and_hash, to_hash, chunksize=64)
+        finally:
+            pool.close()
+            pool.join()
+    for path, size, mtime, hash in hashed:
+        remembered[path] = hash
+    cache.update(dict((path, [size, mtime, hash])
+                      for path, size, mtime, hash in hashed if hash))
+
+    problems = []
+    unverifiable = []
+    for dist in dists:
+        files = records[dist]
+        if files is None:
+            unverifiable.append(dist)
+            continue
+        for path, expected in sorted(files.items()):
+            if expected is None:
+                continue  # RECORD itself, .pyc files, etc.
+            actual = remembered.get(path)
+            if actual is None and not exists(path):
+                problems.append('%s: missing %s' % (dist.project_name, path))
+            elif actual != expected:
+                problems.append('%s: modified %s' % (dist.project_name, path))
+        for path in unexpected_files(dist, files, owned):
+            problems.append('%s: unexpected %s' % (dist.project_name, path))
+
+    if options.requirements:
+        load_pip()
+        installed = dict((dist.key, dist) for dist in dists)
+        for path in options.requirements:
+            for req in _parse_requirements(path, None):
+                if not req.req:
+                    continue
+                # pip 8.1 switched to a different Requirement class, so get
+                # the kind we can compare with a dist:
+                requirement = Requirement.parse(str(req.req))
+                dist = installed.get(requirement.key)
+                if dist is None:
+                    problems.append('%s: not installed, though %s requires it' %
+                                    (requirement, path))
+                elif requirement.specs and dist.version not in requirement:
+                    problems.append('%s: version %s is installed, but %s requires %s' %
+                                    (dist.project_name, dist.version, path, requirement))
+
+    for problem in problems:
+        print(problem)
+    if unverifiable:
+        print('These distributions have no RECORD of hashes, so they could not be '
+              'checked: %s' % ', '.join(d.project_name for d in unverifiable))
+    print('Audited %s files of %s distributions: %s problem%s.' %
+          (len(owned), len(dists) - len(unverifiable), len(problems) or 'no',
+           '' if len(problems) == 1 else 's'))
+    return SOMETHING_WENT_WRONG if problems else ITS_FINE_ITS_FINE
+
+
+def hex_hash(hash):
+    """Turn a peep hash into the hex format pip 8's ``--hash`` wants."""
+    return hexlify(urlsafe_b64decode((hash + '=').encode('ascii'))).decode('ascii')
+
+
+def ported_lines(path, in_place=False):
+    """Yield the lines of a requirements file converted to pip 8's hashing
+    format, reading it as we go.
+
+    :arg in_place: If True, yield the whole file, keeping comments, options,
+        and line endings, for rewriting it. Otherwise, yield just the
+        requirements, under "# from" headers, following ``-r`` includes.
+
+    """
+    with io.open(path, encoding='utf-8', newline='') as file:
+        header_needed = not in_place
+        for comments, spanned in requirement_chunks(file):
+            hashes = [match.group('hash') for match in
+                      (HASH_COMMENT_RE.match(line) for line in comments)
+                      if match]
+            if in_place:
+                for line in comments:
+                    if not HASH_COMMENT_RE.match(line):
+                        yield line
+            if not spanned:
+                continue
+            text, comment = joined_requirement(spanned)
+            included = included_path(path, text)
+            if not in_place and included:
+                for line in ported_lines(included):
+                    yield line
+                header_needed = True
+                continue
+            if not in_place and text.startswith('-') and not re.match(
+                    r'(-e|--editable)\b', text):
+                continue  # Options other than includes aren't requirements.
+
+            if header_needed:
+                yield '\n# from %s\n\n' % path
+                header_needed = False
+            if not hashes:
+                yield ''.join(spanned) if in_place else text + '\n'
+                continue
+            first = spanned[0]
+            indent = first[:len(first) - len(first.lstrip())] if in_place else ''
+            ending = (first[len(first.rstrip('\r\n')):] or '\n') if in_place else '\n'
+            tail = ('  ' + comment) if in_place and comment else ''
+            yield (indent + text + ''.join(' \\%s%s    --hash=sha256:%s' %
+                                           (ending, indent, hex_hash(hash))
+                                           for hash in hashes) +
+                   tail + ending)
+
+
+def peep_port(argv):
+    """Convert peep requirements files to ones compatible with pip 8's
+    hashing. Return a shell status code.
+
+    This works line by line, without pip, so it's quick enough to run across
+    a great many files. Printed results drop comments, leaving cleanup for a
+    human. ``--in-place`` rewrites each file instead, keeping its comments,
+    options, and ordering and changing only the hash lines.
+
+    :arg argv: The commandline args, starting after the subcommand
+
+    """
+    parser = OptionParser(
+        usage='usage: %prog port [--in-place] file [file ...]',
+        description='Convert peep requirements files to the "--hash" format '
+                    'pip 8 understands, printing the results or, with '
+                    '--in-place, overwriting the files.')
+    parser.add_option('--in-place', action='store_true', default=False,
+                      help='Rewrite the files rather than printing them.')
+    options, paths = parser.parse_args(args=argv)
     if not paths:
         print('Please specify one or more requirements files so I have '
               'something to port.\n')
         return COMMAND_LINE_ERROR
 
-    comes_from = None
-    for req in chain.from_iterable(
-            _parse_requirements(path, package_finder(argv)) for path in paths):
-        req_path, req_line = path_and_line(req)
-        hashes = [hexlify(urlsafe_b64decode((hash + '=').encode('ascii'))).decode('ascii')
-                  for hash in hashes_above(req_path, req_line)]
-        if req_path != comes_from:
-            print()
-            print('# from %s' % req_path)
-            print()
-            comes_from = req_path
-
-        if not hashes:
-            print(req.req)
+    for path in paths:
+        if options.in_place:
+            replace_file(path, ported_lines(path, in_place=True))
         else:
-            print('%s' % (req.link if getattr(req, 'link', None) else req.req), end='')
-            for hash in hashes:
-                print(' \\')
-                print('    --hash=sha256:%s' % hash, end='')
-            print()
+            for line in ported_lines(path):
+                sys.stdout.write(line)
+    return ITS_FINE_ITS_FINE
 
 
-def main():
-    """Be the top-level entrypoint. Return a shell status code."""
-    commands = {'hash': peep_hash,
+# Comments which look meant to be hashes, for catching ones which aren't
+# quite right and so would be taken as plain comments
+HASHLIKE_COMMENT_RE = re.compile(r'\s*#\s*(tree-)?sha256\b', re.I)
+
+
+def static_requirements(path, unreadable=None):
+    """Yield (path, line number, requirement text, comment lines above) for
+    each requirement in a requirements file and those it includes, reading
+    them without pip or the network.
+
+    Options other than includes, and editable requirements, are skipped.
+
+    :arg unreadable: A list to append (path, line number, include line text,
+        exception) to for each included file that can't be read, carrying on
+        with the rest. If None, such errors are raised.
+
+    """
+    with io.open(path, encoding='utf-8') as file:
+        line_number = 1
+        for comments, spanned in requirement_chunks(file):
+            line_number += len(comments)
+            if spanned:
+                text, _ = joined_requirement(spanned)
+                included = included_path(path, text)
+                if included:
+                    try:
+                        for requirement in static_requirements(included,
+                                                               unreadable):
+                            yield requirement
+                    except (IOError, OSError, UnicodeDecodeError) as exc:
+                        if unreadable is None:
+                            raise
+                        unreadable.append((path, line_number, text, exc))
+                elif not text.startswith('-'):
+                    yield path, line_number, text, comments
+            line_number += len(spanned)
+
+
+def requirement_spec(text):
+    """Return the requirement from a requirement line's text, and its URL
+    (without fragment) or None, leaving off any per-requirement options."""
+    # In pip 8's format, options can follow the requirement:
+    spec = re.split(r'\s+--?[a-z]', text, 1)[0]
+    url = spec.split('#', 1)[0] if re.match(r'[a-z][a-z0-9+.-]*://', spec, re.I) else None
+    return spec, url
+
+
+def requirement_problems(text, comments):
+    """Return a list of (problem, message) for one requirement, as from
+    ``static_requirements()``, which would fail verification no matter what
+    got downloaded, plus the hashes it's pinned to."""
+    problems = []
+    spec, url = requirement_spec(text)
+    if url:
+        if '#egg=' not in spec and not url.endswith('.whl'):
+            problems.append(('unknown-name', "peep can't determine the package "
+                             'name from this URL. Add #egg=.'))
+    else:
+        try:
+            Requirement.parse(spec)
+        except ValueError:
+            problems.append(('unknown-name', "This isn't a requirement peep "
+                             'can make sense of.'))
+
+    comment_re, kind = ((TREE_HASH_COMMENT_RE, 'tree-sha256') if is_tree_url(url)
+                        else (HASH_COMMENT_RE, 'sha256'))
+    hashes = []
+    if not is_tree_url(url):
+        hashes, bad = option_hashes(text)
+        for value in bad:
+            problems.append(('malformed-hash', '"%s" is not a sha256 hash '
+                             'in hex, the only --hash peep can check.' % value))
+    for line in comments:
+        match = comment_re.match(line)
+        if match:
+            if STORE_KEY_RE.match(match.group('hash')):
+                hashes.append(match.group('hash'))
+            else:
+                problems.append(('malformed-hash', '"%s" is not a sha256 hash in '
+                                 "peep's format." % match.group('hash')))
+        elif (HASHLIKE_COMMENT_RE.match(line) and
+              not (HASH_COMMENT_RE.match(line) or TREE_HASH_COMMENT_RE.match(line))):
+            problems.append(('malformed-hash-comment', 'This looks like a hash '
+                             'but would be ignored as a plain comment: %s' %
+                             line.strip()))
+    if not hashes and not any(p.startswith('malformed-hash') for p, _ in problems):
+        problems.append(('missing-hashes', 'There are no "# %s:" lines above '
+                         'this requirement%s.' %
+                         (kind, '' if kind == 'tree-sha256' else
+                          ' and no --hash=sha256: options on it')))
+    return problems, hashes
+
+
+def peep_check(argv):
+    """Check requirements files for problems that would make ``peep install``
+    fail regardless of what it downloaded--missing, malformed, and
+    conflicting hashes and requirements without determinable names--without
+    pip or the network. Return a shell status code.
+
+    :arg argv: The commandline args, starting after the subcommand
+
+    """
+    parser = OptionParser(
+        usage='usage: %prog check [--json] file [file ...]',
+        description='Check requirements files for problems that would fail '
+                    'verification, without downloading anything.')
+    parser.add_option('-r', '--requirement', dest='paths', action='append',
+                      default=[], help='A requirements file to check. Files '
+                                       'can also be given without -r.')
+    parser.add_option('--json', action='store_true', default=False,
+                      help='Print problems as a JSON list.')
+    options, paths = parser.parse_args(args=argv)
+    paths = options.paths + paths
+    if not paths:
+        parser.print_usage()
+        return COMMAND_LINE_ERROR
+
+    problems = []
+    appearances = defaultdict(list)  # identity -> [(path, line, hash set)]
+    for path in paths:
+        unreadable = []
+        try:
+            requirements = list(static_requirements(path, unreadable))
+        except (IOError, OSError, UnicodeDecodeError) as exc:
+            problems.append(dict(path=path, line=None, requirement=None,
+                                 problem='unreadable', message=str(exc)))
+            continue
+        for req_path, line, text, exc in unreadable:
+            problems.append(dict(path=req_path, line=line, requirement=text,
+                                 problem='unreadable', message=str(exc)))
+        for req_path, line, text, comments in requirements:
+            found, hashes = requirement_problems(text, comments)
+            for problem, message in found:
+                problems.append(dict(path=req_path, line=line, requirement=text,
+                                     problem=problem, message=message))
+            spec, url = requirement_spec(text)
+            key = url or re.sub(r'\s+', '', spec).lower()
+            for other_path, other_line, other_hashes in appearances[key]:
+                if hashes and other_hashes and not set(hashes) & other_hashes:
+                    problems.append(dict(
+                        path=req_path, line=line, requirement=text,
+                        problem='conflicting-hashes',
+                        message='Its hashes have none in common with those at '
+                                '%s line %s.' % (other_path, other_line)))
+                    break
+            appearances[key].append((req_path, line, set(hashes)))
+
+    if options.json:
+        print(json.dumps(problems, indent=2, sort_keys=True))
+    else:
+        for problem in problems:
+            if problem['line'] is None:
+                print('%(path)s: %(message)s' % problem)
+            else:
+                print('%(path)s:%(line)s: %(requirement)s: %(message)s' % problem)
+    return SOMETHING_WENT_WRONG if problems else ITS_FINE_ITS_FINE
+
+
+def install_via_daemon(socket_path, argv):
+    """Have a ``peep serve`` daemon do a ``peep install`` for us, relaying its
+    output as it comes. Return its shell status code.
+
+    :arg socket_path: The path to the daemon's unix-domain socket
+    :arg argv: The commandline args, starting after the subcommand, minus the
+        ones about reaching the daemon
+
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        print("peep install --daemon isn't supported on this platform.")
+        return COMMAND_LINE_ERROR
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except socket.error as exc:
+        print("Couldn't reach a peep daemon at %s: %s\n"
+              "Start one with `peep serve`." % (socket_path, exc))
+        return SOMETHING_WENT_WRONG
+
+    # The daemon installs from our point of view: our working dir, our
+    # environment variables, and our Python environment.
+    request = {'argv': argv,
+               'cwd': os.getcwd(),
+               'environ': dict(os.environ),
+               'prefix': sys.prefix,
+               'executable': sys.executable}
+    client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+    # Output streams back until a NUL, after which comes the status code:
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    trailer = None
+    while True:
+        chunk = client.recv(2 ** 16)
+        if not chunk:
+            break
+        if trailer is not None:
+            trailer += chunk
+        else:
+            output, nul, rest = chunk.partition(b'\0')
+            out.write(output)
+            out.flush()
+            if nul:
+                trailer = rest
+    client.close()
+    try:
+        return int(trailer)
+    except (TypeError, ValueError):
+        print('The peep daemon hung up before finishing.')
+        return SOMETHING_WENT_WRONG
+
+
+class DaemonRequestHandler(StreamRequestHandler):
+    """A handler which performs one client's ``peep install``, streaming its
+    output back over the socket
+
+    The server forks before calling me, so I can change the working dir,
+    environment, and file descriptors without disturbing other clients.
+
+    """
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Send the output of pip, setup.py, and everything else our way:
+        os.dup2(self.connection.fileno(), 1)
+        os.dup2(self.connection.fileno(), 2)
+
+        temp_root = mkdtemp(prefix='peep-client-')
+        try:
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            os.environ.update(request['environ'])
+            # Keep each client's downloads in a dir of its own:
+            tempfile.tempdir = temp_root
+            # Only pip's import and arg parser are kept warm. Everything else
+            # pip is configured by is read for each client, its config files
+            # included:
+            refresh_pip_config()
+            argv = request['argv']
+            try:
+                given, _ = peep_options(argv)
+            except OptionError:
+                pass  # run_command() will report it.
+            else:
+                if given.store is None:
+                    argv = argv + ['--store', self.server.store_root]
+                # Install into the client's environment, if it isn't ours:
+                if request['prefix'] != sys.prefix and not given.target_envs:
+                    argv = argv + ['--target-env', request['executable']]
+            status = run_command(['install'] + argv)
+        except Exception:
+            exception_handler(*sys.exc_info())
+            status = UNHANDLED_EXCEPTION
+        finally:
+            tempfile.tempdir = None
+            rmtree(temp_root, ignore_errors=True)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.wfile.write(('\0%d\n' % status).encode('ascii'))
+
+
+def peep_serve(argv):
+    """Run a daemon which does ``peep install`` on behalf of ``peep install
+    --daemon`` clients, returning a shell status code.
+
+    pip is imported and its arg parser prepared once, up front. Each client is
+    then served by a forked copy of this warm process, and they all share one
+    store of verified archives.
+
+    :arg argv: The commandline args, starting after the subcommand
+
+    """
+    parser = OptionParser(
+        usage='usage: %prog serve [options]',
+        description='Serve "peep install --daemon" requests on a '
+                    'unix-domain socket.')
+    parser.add_option('--socket', default=DEFAULT_SOCKET,
+                      help='Path of the socket to listen on. Default: %default')
+    parser.add_option('--store', default=None,
+                      help='Directory of verified archives to share among '
+                           'clients. Default: "store" next to the socket')
+    options, _ = parser.parse_args(args=argv)
+    if not (hasattr(socket, 'AF_UNIX') and hasattr(os, 'fork')):
+        print("peep serve isn't supported on this platform.")
+        return COMMAND_LINE_ERROR
+
+    class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+        store_root = options.store or join(dirname(options.socket), 'store')
+
+    # Warm up. Building a finder imports most of pip and whatever it uses to
+    # talk to indices.
+    package_finder([])
+
+    # Whoever can connect can run setup.py as us, so keep others out:
+    makedirs(dirname(options.socket), 0o700)
+    if exists(options.socket):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(options.socket)
+        except socket.error:
+            os.remove(options.socket)  # left over from a dead daemon
+        else:
+            print('A peep daemon is already listening on %s.' % options.socket)
+            return SOMETHING_WENT_WRONG
+        finally:
+            probe.close()
+    server = Server(options.socket, DaemonRequestHandler, bind_and_activate=False)
+    try:
+        server.server_bind()
+        os.chmod(options.socket, 0o600)
+        server.server_activate()
+    except Exception:
+        server.server_close()
+        raise
+    print('Serving peep installs on %s' % options.socket)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(options.socket)
+    return ITS_FINE_ITS_FINE
+
+
+class StoreRequestHandler(BaseHTTPRequestHandler):
+    """An HTTP handler which serves the archives in an ArchiveStore, each
+    at ``/<peep hash>``"""
+
+    def do_GET(self):
+        self.send_archive(with_body=True)
+
+    def do_HEAD(self):
+        self.send_archive(with_body=False)
+
+    def send_archive(self, with_body):
+        path = self.server.store.path(self.path.strip('/').split('?', 1)[0])
+        if not path:
+            self.send_error(404, 'No archive has that hash.')
+            return
+        with open(path, 'rb') as archive:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.fstat(archive.fileno()).st_size))
+            self.send_header('Content-Disposition',
+                             'attachment; filename="%s"' % basename(path))
+            self.end_headers()
+            if with_body:
+                while True:
+                    data = archive.read(2 ** 20)
+                    if not data:
+                        break
+                    self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        """Log to stdout, to be consistent with everything else."""
+        print('%s - %s' % (self.address_string(), format % args))
+
+
+def peep_proxy(argv):
+    """Serve a store of verified archives over HTTP, by peep hash, for
+    ``peep install --hash-server`` to try before going upstream. Return a
+    shell status code.
+
+    :arg argv: The commandline args, starting after the subcommand
+
+    """
+    parser = OptionParser(
+        usage='usage: %prog proxy [options]',
+        description='Serve a store of verified archives over HTTP, each at '
+                    '/<peep hash>.')
+    parser.add_option('--store', default=join(dirname(DEFAULT_SOCKET), 'store'),
+                      help='Directory of verified archives to serve, as made by '
+                           'peep install --store. Default: %default')
+    parser.add_option('--host', default='',
+                      help='Address to listen on. Default: all of them')
+    parser.add_option('--port', type='int', default=8080,
+                      help='Port to listen on, or 0 for any free one. '
+                           'Default: %default')
+    options, _ = parser.parse_args(args=argv)
+
+    class Server(socketserver.ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        store = ArchiveStore(options.store)
+
+    server = Server((options.host, options.port), StoreRequestHandler)
+    print('Serving %s on http://%s:%s/' % (options.store,
+                                           options.host or 'localhost',
+                                           server.server_address[1]))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return ITS_FINE_ITS_FINE
+
+
+def run_command(args):
+    """Run a peep subcommand, falling through to pip for ones we don't
+    handle. Return a shell status code.
+
+    :arg args: The commandline args, starting with the subcommand
+
+    """
+    commands = {'audit': peep_audit,
+                'bundle': peep_bundle,
+                'cache': peep_cache,
+                'check': peep_check,
+                'fetch': peep_fetch,
+                'hash': peep_hash,
                 'install': peep_install,
-                'port': peep_port}
+                'lock': peep_lock,
+                'port': peep_port,
+                'proxy': peep_proxy,
+                'serve': peep_serve,
+                'sync': peep_sync,
+                'upgrade': peep_upgrade,
+                'unbundle': peep_unbundle}
     try:
-        if len(argv) >= 2 and argv[1] in commands:
-            return commands[argv[1]](argv[2:])
+        if args and args[0] in commands:
+            return commands[args[0]](args[1:])
         else:
             # Fall through to top-level pip main() for everything else:
-            return pip.main()
+            load_pip()
+            return pip.main(args)
     except PipException as exc:
         return exc.error_code
+    except OptionError as exc:
+        print(exc)
+        return COMMAND_LINE_ERROR
+    finally:
+        METRICS.export()
+
+
+def main():
+    """Be the top-level entrypoint. Return a shell status code."""
+    return run_command(argv[1:])
 
 
 def exception_handler(exc_type, exc_value, exc_tb):
@@ -1,24 +1,29 @@
 from __future__ import print_function
 from contextlib import contextmanager
+from distutils.sysconfig import get_python_lib
 from functools import partial
+import json
 try:
     from imp import reload  # Python 3
 except ImportError:
     pass
-from os import curdir, environ, pardir
-from os.path import dirname, isfile, join, split, splitdrive
-from shutil import rmtree
+from os import (chmod, curdir, environ, listdir, makedirs, pardir, remove, stat,
+                utime, walk)
+from os.path import dirname, exists, getsize, isfile, join, split, splitdrive
+from shutil import copy, rmtree
 try:
     from SimpleHTTPServer import SimpleHTTPRequestHandler
 except ImportError:
     from http.server import SimpleHTTPRequestHandler
 import socket
+import sys
 try:
     from SocketServer import TCPServer
 except ImportError:
     from socketserver import TCPServer
 from pipes import quote
 from posixpath import normpath
+import re
 from subprocess import CalledProcessError, PIPE, Popen
 try:
     from subprocess import check_output
@@ -33,10 +38,13 @@ except ImportError:  # py2.6
             cmd = kwargs.get("args")
             if cmd is None:
                 cmd = popenargs[0]
-            raise CalledProcessError(retcode, cmd)
+            error = CalledProcessError(retcode, cmd)
+            error.output = output
+            raise error
         return output
 from tempfile import mkdtemp
 from threading import Thread
+from time import time
 from unittest import TestCase
 try:
     from urllib import unquote
@@ -44,9 +52,22 @@ except ImportError:
     from urllib.parse import unquote
 
 from nose import SkipTest
-from nose.tools import eq_, nottest
+from nose.tools import eq_, nottest, ok_
 
-from peep import SOMETHING_WENT_WRONG, downloaded_reqs_from_path, MissingReq, xrange, activate
+# Keep what peep remembers between runs--download sizes, install
+# fingerprints, and such--out of the real ~/.peep. This has to happen before
+# peep is imported, since that's when it looks for ~.
+HOME = mkdtemp(prefix='peep-home-')
+environ['HOME'] = HOME
+
+from peep import (SOMETHING_WENT_WRONG, downloaded_reqs_from_path, MissingReq, xrange, activate,
+                  verify, InstallableReq, tree_hash, RateLimit, Progress,
+                  hex_hash, hash_of_file, copy_tree_and_hash, write_bundle,
+                  extract_bundle, is_local)
+
+
+def teardown_package():
+    rmtree(HOME)
 
 
 @contextmanager
@@ -96,6 +117,19 @@ def running_setup_py(should_run_it=True, should_make_sure_did_not_upgrade=False)
                 eq_(file.read(), 'oh no!')
 
 
+def make_virtualenv(path):
+    """Make a fresh virtualenv, with pip, at ``path`` for the Python the
+    tests run under. Skip the test if there's no way to."""
+    for command in ['{python} -m venv {path}', 'virtualenv -p {python} {path}']:
+        try:
+            run(command + ' 2>&1', python=python_path(), path=path)
+        except CalledProcessError:
+            rmtree(path, ignore_errors=True)
+        else:
+            return
+    raise SkipTest("Couldn't make a virtualenv for this Python.")
+
+
 def run(command, **kwargs):
     """Run and return the output of a command.
 
@@ -139,6 +173,12 @@ def peep_path():
     return join(dirname(tests_dir()), 'peep.py')
 
 
+def stored(store):
+    """Return the sorted hashes of the archives in a store, leaving out its
+    lock files."""
+    return sorted(name for name in listdir(store) if not name.startswith('.'))
+
+
 class RequestHandler(SimpleHTTPRequestHandler):
     """An HTTP request handler which is quiet and serves a specific folder."""
 
@@ -150,9 +190,44 @@ class RequestHandler(SimpleHTTPRequestHandler):
         self.root = kwargs.pop('root')  # required kwarg
         SimpleHTTPRequestHandler.__init__(self, *args, **kwargs)
 
+    # Paths of all GET requests served, for tests that count fetches
+    requested = []
+
+    # A Content-Disposition header to send with everything, if not None, for
+    # tests of misbehaving servers
+    disposition = None
+
+    # Whether to answer range requests with nonsense, for the same
+    garbled_ranges = False
+
     def log_message(self, format, *args):
         """Don't log each request to the terminal."""
 
+    def do_GET(self):
+        """Serve a file or, if a single byte range of it is asked for, just
+        those bytes."""
+        self.requested.append(self.path)
+        match = re.match(r'^bytes=(\d+)-(\d+)$', self.headers.get('Range', ''))
+        if not match:
+            return SimpleHTTPRequestHandler.do_GET(self)
+        if self.garbled_ranges:
+            self.wfile.write(b'garbage\r\n\r\n')
+            return
+        start, end = int(match.group(1)), int(match.group(2))
+        with open(self.translate_path(self.path), 'rb') as file:
+            data = file.read()
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, len(data)))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(data[start:end + 1])
+
+    def end_headers(self):
+        self.send_header('Accept-Ranges', 'bytes')
+        if self.disposition is not None:
+            self.send_header('Content-Disposition', self.disposition)
+        SimpleHTTPRequestHandler.end_headers(self)
+
     # Adapted from the implementation in the superclass
     def translate_path(self, path):
         """Translate a /-separated PATH to the local filename syntax, rooting
@@ -317,6 +392,39 @@ class FullStackTests(ServerTestCase):
         # No exception raised == happiness.
         run('pip uninstall -y useless')
 
+    def test_success_hash_options(self):
+        """peep should also accept pip 8's ``--hash`` options, in hex, even
+        spread across continuation lines."""
+        try:
+            activate('pip>=8.0')
+        except RuntimeError:
+            raise SkipTest("pip can't parse --hash options until 8.0.")
+        with running_setup_py(should_make_sure_did_not_upgrade=True):
+            self.install_from_string(
+                """useless==1.0 \\
+                    --hash=sha256:%s""" %
+                hex_hash('f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10'))
+        run('pip uninstall -y useless')
+
+    def test_hash_options_old_pip(self):
+        """Under a pip too old for ``--hash`` options, peep should say so
+        rather than let pip choke on them."""
+        try:
+            activate('pip>=8.0')
+        except RuntimeError:
+            pass
+        else:
+            raise SkipTest('This pip is new enough to parse --hash options.')
+        try:
+            self.install_from_string('useless==1.0 --hash=sha256:%s' %
+                                     hex_hash('f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10'))
+        except CalledProcessError as exc:
+            eq_(exc.returncode, SOMETHING_WENT_WRONG)
+            ok_(b'line 1 has --hash options, which pip understands only as of 8.0'
+                in exc.output)
+        else:
+            self.fail("Peep exited successfully but shouldn't have.")
+
     def test_mismatch(self):
         """If a hash doesn't match, peep should explode."""
         with running_setup_py(False):
@@ -398,21 +506,736 @@ class FullStackTests(ServerTestCase):
         # Clean up:
         run('pip uninstall -y useless')
 
-    def test_port(self):
-        """Test peep port."""
-        # We can't get the package name from URL-based requirements before pip
-        # 1.0. Tolerate it so we can at least test everything else:
+    def test_no_op(self):
+        """Installing again, with nothing changed, should stop short, unless
+        ``--force`` is given."""
+        reqs = """# sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                  useless==1.0"""
+        with requirements(reqs) as reqs_path:
+            try:
+                with running_setup_py():
+                    self.install_from_path(reqs_path)
+                ok_(b'Nothing has changed' in self.install_from_path(reqs_path))
+                output = run('{python} {peep} install -r {reqs} --index-url {local} --force',
+                             python=python_path(), peep=peep_path(),
+                             reqs=reqs_path, local=self.index_url())
+                ok_(b'Nothing has changed' not in output)
+                ok_(b'already installed' in output)
+
+                # Fingerprints kept elsewhere know nothing of that install:
+                with ephemeral_dir() as temp_dir:
+                    output = run('{python} {peep} install -r {reqs} --index-url {local} '
+                                 '--fingerprints {fingerprints}',
+                                 python=python_path(), peep=peep_path(),
+                                 reqs=reqs_path, local=self.index_url(),
+                                 fingerprints=join(temp_dir, 'installed.json'))
+                    ok_(b'Nothing has changed' not in output)
+                    ok_(isfile(join(temp_dir, 'installed.json')))
+
+                # Uninstalling changes the environment, so peep notices:
+                run('pip uninstall -y useless')
+                with running_setup_py():
+                    self.install_from_path(reqs_path)
+            finally:
+                run('pip uninstall -y useless')
+
+    def test_compile(self):
+        """Bytecode should be compiled after installation, at every
+        optimization level asked for."""
+        levels = '0,1' if sys.version_info >= (3, 5) else '0'
+        source = join(get_python_lib(), 'useless.py')
         try:
-            activate('pip>=6.1.0')
+            with running_setup_py():
+                with requirements("""# sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                                  useless==1.0""") as reqs_path:
+                    run('{python} {peep} install -r {reqs} --index-url {local} '
+                        '--compile-levels {levels}',
+                        python=python_path(), peep=peep_path(), reqs=reqs_path,
+                        local=self.index_url(), levels=levels)
+            if sys.version_info >= (3, 5):
+                from importlib.util import cache_from_source
+                ok_(isfile(cache_from_source(source, optimization='')))
+                ok_(isfile(cache_from_source(source, optimization=1)))
+            elif sys.version_info < (3,):
+                ok_(isfile(source + 'c'))
+        finally:
+            run('pip uninstall -y useless')
+
+    def test_compile_elsewhere(self):
+        """When pip is told to put things off our sys.path, where we can't
+        find them to compile afterward, pip should compile them itself."""
+        with ephemeral_dir() as target:
+            with running_setup_py():
+                with requirements("""# sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                                  useless==1.0""") as reqs_path:
+                    # Let pip compile even if this environment says not to:
+                    run('env -u PYTHONDONTWRITEBYTECODE '
+                        '{python} {peep} install -r {reqs} --index-url {local} '
+                        '--target {target}',
+                        python=python_path(), peep=peep_path(), reqs=reqs_path,
+                        local=self.index_url(), target=target)
+            ok_(isfile(join(target, 'useless.py')))
+            ok_(any(name.endswith('.pyc')
+                    for _, _, names in walk(target) for name in names))
+
+    def test_daemon(self):
+        """A ``peep serve`` daemon should install on behalf of ``peep install
+        --daemon`` clients, reporting back the same exit codes and storing
+        what it verified."""
+        with ephemeral_dir() as temp_dir:
+            socket_path = join(temp_dir, 'serve.sock')
+            daemon = Popen([python_path(), peep_path(), 'serve', '--socket', socket_path],
+                           stdout=PIPE)
+            try:
+                daemon.stdout.readline()  # Wait for it to start listening.
+                # Only we may connect, since the daemon runs setup.py for us:
+                eq_(stat(socket_path).st_mode & 0o777, 0o600)
+                install = ('{python} {peep} install --daemon --socket {socket} '
+                           '-r {reqs} --index-url={local} --store={store}')
+                with running_setup_py(should_make_sure_did_not_upgrade=True):
+                    with requirements("""# sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                                      useless==1.0""") as reqs_path:
+                        run(install, python=python_path(), peep=peep_path(),
+                            socket=socket_path, reqs=reqs_path, local=self.index_url(),
+                            store=join(temp_dir, 'client-store'))
+                run('pip uninstall -y useless')
+                # The client's own --store=DIR wins over the daemon's:
+                ok_(not exists(join(temp_dir, 'store')))
+                eq_(stored(join(temp_dir, 'client-store')),
+                    ['f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10'])
+
+                with running_setup_py(False):
+                    with requirements("""# sha256: badbadbad
+                                      useless==1.0""") as reqs_path:
+                        try:
+                            run(install, python=python_path(), peep=peep_path(),
+                                socket=socket_path, reqs=reqs_path, local=self.index_url(),
+                                store=join(temp_dir, 'store'))
+                        except CalledProcessError as exc:
+                            eq_(exc.returncode, SOMETHING_WENT_WRONG)
+                        else:
+                            self.fail("Peep exited successfully but shouldn't have.")
+
+                # pip config written after the daemon started still counts:
+                config_path = join(temp_dir, 'pip.conf')
+                with open(config_path, 'w') as file:
+                    file.write('[global]\nindex-url = %s\n' % self.index_url())
+                with running_setup_py(should_make_sure_did_not_upgrade=True):
+                    with requirements("""# sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                                      useless==1.0""") as reqs_path:
+                        run('env -u PIP_INDEX_URL PIP_CONFIG_FILE={config} '
+                            '{python} {peep} install --daemon --socket {socket} -r {reqs} '
+                            '--store={store}',
+                            config=config_path, python=python_path(), peep=peep_path(),
+                            socket=socket_path, reqs=reqs_path, store=join(temp_dir, 'store'))
+                run('pip uninstall -y useless')
+            finally:
+                daemon.terminate()
+                daemon.wait()
+
+    def test_hash_server(self):
+        """``peep install --hash-server`` should fetch archives by hash from a
+        ``peep proxy``, never needing the index."""
+        hash = 'f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10'
+        with ephemeral_dir() as store:
+            makedirs(join(store, hash))
+            copy(join(tests_dir(), 'packages', 'useless', 'useless-1.0.tar.gz'),
+                 join(store, hash))
+            proxy = Popen([python_path(), peep_path(), 'proxy', '--store', store,
+                           '--host', 'localhost', '--port', '0'],
+                          stdout=PIPE)
+            try:
+                # "Serving <store> on http://localhost:<port>/"
+                url = proxy.stdout.readline().decode('ascii').split()[-1]
+                with running_setup_py(should_make_sure_did_not_upgrade=True):
+                    with requirements("""# sha256: %s
+                                      useless==1.0""" % hash) as reqs_path:
+                        run('{python} {peep} install -r {reqs} --no-index '
+                            '--hash-server {url}',
+                            python=python_path(), peep=peep_path(),
+                            reqs=reqs_path, url=url)
+                run('pip uninstall -y useless')
+            finally:
+                proxy.terminate()
+                proxy.wait()
+
+    def test_hash_server_filename(self):
+        """A ``--hash-server`` shouldn't be able to make peep write outside its
+        temp dir by sending a filename full of "..".
+        """
+        hash = 'f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10'
+        with ephemeral_dir() as root:
+            copy(join(tests_dir(), 'packages', 'useless', 'useless-1.0.tar.gz'),
+                 join(root, hash))
+            escaped = join(root, 'escaped.tar.gz')
+            RequestHandler.disposition = 'attachment; filename="%s%s"' % (
+                '../' * 30, escaped.lstrip('/'))
+            server = TCPServer(('localhost', 0), partial(RequestHandler, root=root))
+            thread = Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                with running_setup_py(should_make_sure_did_not_upgrade=True):
+                    with requirements("""# sha256: %s
+                                      useless==1.0""" % hash) as reqs_path:
+                        run('{python} {peep} install -r {reqs} --no-index '
+                            '--hash-server http://localhost:{port}/',
+                            python=python_path(), peep=peep_path(),
+                            reqs=reqs_path, port=str(server.server_address[1]))
+                run('pip uninstall -y useless')
+                ok_(not exists(escaped))
+            finally:
+                RequestHandler.disposition = None
+                server.shutdown()
+                thread.join()
+                server.server_close()
+
+    def test_sharded_fetch(self):
+        """``peep fetch --shard`` should fetch a deterministic share of the
+        requirements, biggest first, and together the shards should fetch
+        everything."""
+        with ephemeral_dir() as store:
+            with requirements("""
+                    # sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                    # size: 10K
+                    useless==1.0
+                    # sha256: Q7PVYWdV3NFZ3bkx5bNmUd74UTCe7jrwf2AeM4wUD1A
+                    # size: 5K
+                    {index_url}useless/1234567.zip#egg=useless
+                    """.format(index_url=self.index_url())) as reqs_path:
+                fetch = ('{python} {peep} fetch -r {reqs} --index-url {local} '
+                         '--store {store} --shard {shard}')
+                run(fetch, python=python_path(), peep=peep_path(), reqs=reqs_path,
+                    local=self.index_url(), store=store, shard='1/2')
+                eq_(stored(store), ['f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10'])
+                run(fetch, python=python_path(), peep=peep_path(), reqs=reqs_path,
+                    local=self.index_url(), store=store, shard='2/2')
+                eq_(stored(store),
+                    ['Q7PVYWdV3NFZ3bkx5bNmUd74UTCe7jrwf2AeM4wUD1A',
+                     'f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10'])
+
+    def test_duplicates_across_files(self):
+        """A requirement repeated across files should be downloaded once and
+        accept the hashes from all its appearances. Disjoint hashes should be
+        reported as a conflict."""
+        good = """# sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                  useless==1.0"""
+        install = '{python} {peep} install -r {base} -r {prod} --index-url {local}'
+        with requirements(good) as base:
+            with requirements('useless==1.0') as prod:
+                with running_setup_py():
+                    output = run(install, python=python_path(), peep=peep_path(),
+                                 base=base, prod=prod, local=self.index_url())
+                eq_(output.decode('ascii').count('Downloading'), 1)
+                run('pip uninstall -y useless')
+
+            with requirements("""# sha256: badbadbad
+                              useless==1.0""") as prod:
+                with running_setup_py(False):
+                    try:
+                        run(install, python=python_path(), peep=peep_path(),
+                            base=base, prod=prod, local=self.index_url())
+                    except CalledProcessError as exc:
+                        eq_(exc.returncode, SOMETHING_WENT_WRONG)
+                        assert b'appear more than once' in exc.output
+                    else:
+                        self.fail("Peep exited successfully but shouldn't have.")
+
+    def test_concurrent_fetch(self):
+        """``--jobs`` should download concurrently and remember archive sizes
+        for scheduling later runs."""
+        with ephemeral_dir() as temp_dir:
+            stats_path = join(temp_dir, 'sizes.json')
+            with requirements("""
+                    # sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                    useless==1.0
+                    # sha256: Q7PVYWdV3NFZ3bkx5bNmUd74UTCe7jrwf2AeM4wUD1A
+                    {index_url}useless/1234567.zip#egg=useless
+                    """.format(index_url=self.index_url())) as reqs_path:
+                run('{python} {peep} fetch -r {reqs} --index-url {local} '
+                    '--store {store} --jobs 2 --size-stats {stats}',
+                    python=python_path(), peep=peep_path(), reqs=reqs_path,
+                    local=self.index_url(), store=join(temp_dir, 'store'),
+                    stats=stats_path)
+            eq_(len(stored(join(temp_dir, 'store'))), 2)
+            with open(stats_path) as file:
+                sizes = json.load(file)
+            eq_(sizes['useless==1.0'],
+                getsize(join(tests_dir(), 'packages', 'useless', 'useless-1.0.tar.gz')))
+            eq_(len(sizes), 2)
+
+    def test_single_flight(self):
+        """Concurrent peep processes sharing a store should download an
+        archive only once, even if their requirements list different sets of
+        hashes for it."""
+        del RequestHandler.requested[:]
+        with ephemeral_dir() as temp_dir:
+            with requirements("""
+                    # sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                    useless==1.0
+                    """) as reqs_path:
+                with requirements("""
+                        # sha256: Q7PVYWdV3NFZ3bkx5bNmUd74UTCe7jrwf2AeM4wUD1A
+                        # sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                        useless==1.0
+                        """) as more_hashes_path:
+                    # Throttle so the fetches overlap:
+                    processes = [
+                        Popen([python_path(), peep_path(), 'fetch', '-r', path,
+                               '--index-url', self.index_url(),
+                               '--store', join(temp_dir, 'store'),
+                               '--limit-rate', '400'],
+                              stdout=PIPE, stderr=PIPE)
+                        for path in [reqs_path, more_hashes_path, reqs_path]]
+                    for process in processes:
+                        process.communicate()
+                        eq_(process.returncode, 0)
+        eq_(RequestHandler.requested.count('/useless/useless-1.0.tar.gz'), 1)
+
+    def test_segments(self):
+        """Big archives should be downloaded as several byte ranges at once
+        and still pass verification."""
+        del RequestHandler.requested[:]
+        with ephemeral_dir() as temp_dir:
+            with requirements("""
+                    # sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                    useless==1.0
+                    """) as reqs_path:
+                # Each segment waits its turn for the host's only slot:
+                run('{python} {peep} fetch -r {reqs} --index-url {local} '
+                    '--store {store} --segments 3 --segment-above 100 '
+                    '--max-per-host 1',
+                    python=python_path(), peep=peep_path(), reqs=reqs_path,
+                    local=self.index_url(), store=join(temp_dir, 'store'))
+        # One request finds the size, and then one for each segment:
+        eq_(RequestHandler.requested.count('/useless/useless-1.0.tar.gz'), 4)
+
+    def test_segment_errors(self):
+        """A segment which fails in an unexpected way should fail the
+        download, not leave peep waiting for it forever."""
+        RequestHandler.garbled_ranges = True
+        try:
+            with ephemeral_dir() as temp_dir:
+                with requirements("""
+                        # sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                        useless==1.0
+                        """) as reqs_path:
+                    try:
+                        run('timeout 60 {python} {peep} fetch -r {reqs} '
+                            '--index-url {local} --store {store} '
+                            '--segment-above 100 2>&1',
+                            python=python_path(), peep=peep_path(), reqs=reqs_path,
+                            local=self.index_url(), store=join(temp_dir, 'store'))
+                    except CalledProcessError as exc:
+                        ok_(exc.returncode != 124)  # timed out
+                        ok_(b'Downloading' in exc.output and b'failed' in exc.output)
+                    else:
+                        self.fail("peep fetch didn't fail on garbled segments.")
+        finally:
+            RequestHandler.garbled_ranges = False
+
+    def test_sync(self):
+        """``peep sync`` should download only what's changed and remove what
+        nothing asks for."""
+        def sync(reqs):
+            with requirements(reqs) as reqs_path:
+                return run('{python} {peep} sync --dry-run -r {reqs} '
+                           '--index-url {local}',
+                           python=python_path(), peep=peep_path(),
+                           reqs=reqs_path, local=self.index_url()).decode('ascii')
+
+        with running_setup_py():
+            self.install_from_string("""
+                # sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                useless==1.0""")
+        try:
+            del RequestHandler.requested[:]
+            output = sync("""
+                # sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                useless==1.0""")
+            ok_('useless' not in output)
+            ok_('Would remove nose.' in output)
+            output = sync("""
+                # sha256: Q7PVYWdV3NFZ3bkx5bNmUd74UTCe7jrwf2AeM4wUD1A
+                {index_url}useless/1234567.zip#egg=useless""".format(
+                index_url=self.index_url()))
+            ok_('Would upgrade to useless' in output)
+            ok_('Would remove useless.' in sync('# Nothing at all'))
+            eq_(RequestHandler.requested, [])
+        finally:
+            run('pip uninstall -y useless')
+
+    def test_bundle(self):
+        """``peep bundle`` should pack verified, installed requirements into
+        one archive, which ``peep unbundle`` unpacks only if its hash
+        matches."""
+        try:
+            activate('pip>=8.0')
         except RuntimeError:
+            raise SkipTest("pip can't install into a --prefix until 8.0.")
+        with ephemeral_dir() as temp_dir:
+            bundle = join(temp_dir, 'env.tar.gz')
+            with running_setup_py():
+                with requirements("""
+                        # sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                        useless==1.0
+                        """) as reqs_path:
+                    output = run('{python} {peep} bundle -r {reqs} --index-url {local} '
+                                 '--output {bundle}',
+                                 python=python_path(), peep=peep_path(),
+                                 reqs=reqs_path, local=self.index_url(),
+                                 bundle=bundle).decode('ascii')
+            hash = output.split('--hash ')[1].split()[0]
+
+            # A wrong hash unpacks nothing:
+            prefix = join(temp_dir, 'env')
             try:
-                activate('pip>=1.0.1')
-            except RuntimeError:
-                schema_package_name = 'None'
+                run('{python} {peep} unbundle {bundle} --hash {hash} --prefix {prefix}',
+                    python=python_path(), peep=peep_path(), bundle=bundle,
+                    hash='f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10', prefix=prefix)
+            except CalledProcessError:
+                pass
             else:
-                schema_package_name = 'schema'
+                self.fail("Unbundling with the wrong hash didn't fail.")
+            eq_(listdir(prefix), [])
+
+            run('{python} {peep} unbundle {bundle} --hash {hash} --prefix {prefix}',
+                python=python_path(), peep=peep_path(), bundle=bundle,
+                hash=hash, prefix=prefix)
+            site_packages = run('{python} -c "from distutils.sysconfig import '
+                                'get_python_lib; print(get_python_lib(prefix=\'\'))"',
+                                python=python_path()).decode('ascii').strip()
+            ok_(isfile(join(prefix, site_packages, 'useless.py')))
+
+    def test_bundle_old_pip(self):
+        """``peep bundle`` should refuse cleanly under a pip too old to
+        install into a prefix."""
+        try:
+            activate('pip>=8.0')
+        except RuntimeError:
+            pass
         else:
-            schema_package_name = 'https://github.com/erikrose/schema/archive/99dc4130f0f05fd3c2d4bc6663a2419851f3c90f.zip#egg=schema'
+            raise SkipTest('This pip is new enough to bundle with.')
+        with requirements('useless==1.0\n') as reqs_path:
+            try:
+                run('{python} {peep} bundle -r {reqs} --output env.tar.gz',
+                    python=python_path(), peep=peep_path(), reqs=reqs_path)
+            except CalledProcessError as exc:
+                eq_(exc.returncode, 2)
+                ok_(b'peep bundle needs pip 8.0 or later' in exc.output)
+            else:
+                self.fail("peep bundle didn't refuse to run under old pip.")
+
+    def test_cache_verify(self):
+        """``peep cache verify`` should quarantine damaged archives and skip
+        ones checked recently."""
+        with ephemeral_dir() as store:
+            archive = join(tests_dir(), 'packages', 'useless', 'useless-1.0.tar.gz')
+            for hash in ['f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10',
+                         'Q7PVYWdV3NFZ3bkx5bNmUd74UTCe7jrwf2AeM4wUD1A']:
+                makedirs(join(store, hash))
+                copy(archive, join(store, hash))
+            # The damaged one passed once, long ago:
+            with open(join(store, '.verified.json'), 'w') as file:
+                json.dump({'Q7PVYWdV3NFZ3bkx5bNmUd74UTCe7jrwf2AeM4wUD1A': 1}, file)
+            verify = '{python} {peep} cache verify --store {store}'
+            try:
+                run(verify, python=python_path(), peep=peep_path(), store=store)
+            except CalledProcessError as exc:
+                ok_('Rehashed 2 of the 2 archives' in exc.output.decode('ascii'))
+            else:
+                self.fail("The damaged archive wasn't reported.")
+            eq_(stored(store), ['f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10'])
+            eq_(len(listdir(join(store, '.quarantine'))), 1)
+            with open(join(store, '.verified.json')) as file:
+                eq_(list(json.load(file)), ['f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10'])
+
+            output = run(verify, python=python_path(), peep=peep_path(), store=store)
+            ok_('Rehashed 0 of the 1 archives' in output.decode('ascii'))
+
+    def test_metrics(self):
+        """``--metrics-file`` and ``--statsd`` should report what happened."""
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(10)
+        try:
+            with ephemeral_dir() as temp_dir:
+                metrics_path = join(temp_dir, 'peep.prom')
+                with requirements("""
+                        # sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                        useless==1.0
+                        """) as reqs_path:
+                    run('{python} {peep} fetch -r {reqs} --index-url {local} '
+                        '--store {store} --metrics-file {metrics} --statsd {statsd}',
+                        python=python_path(), peep=peep_path(), reqs=reqs_path,
+                        local=self.index_url(), store=join(temp_dir, 'store'),
+                        metrics=metrics_path,
+                        statsd='127.0.0.1:%s' % listener.getsockname()[1])
+                with open(metrics_path) as file:
+                    metrics = file.read()
+            ok_('peep_requirements_total{kind="InstallableReq"} 1\n' in metrics)
+            ok_('peep_downloaded_bytes_total{host="localhost:%s"} %s\n' %
+                (self.port,
+                 getsize(join(tests_dir(), 'packages', 'useless', 'useless-1.0.tar.gz')))
+                in metrics)
+            received = b''
+            while b'peep_requirements_total.InstallableReq:1|c' not in received:
+                received += listener.recv(4096)  # or time out
+        finally:
+            listener.close()
+
+    def test_tree(self):
+        """Local directories should be locked and verified by tree hash."""
+        with ephemeral_dir() as temp_dir:
+            tree = join(temp_dir, 'treepkg')
+            makedirs(tree)
+            with open(join(tree, 'setup.py'), 'w') as file:
+                file.write('from setuptools import setup\nsetup(name="treepkg")\n')
+            with requirements('file://%s#egg=treepkg\n' % tree) as reqs_path:
+                run('{python} {peep} lock -r {reqs}',
+                    python=python_path(), peep=peep_path(), reqs=reqs_path)
+                with open(reqs_path) as file:
+                    ok_(file.read().startswith('# tree-sha256: %s\n' % tree_hash(tree)))
+
+                # pip should build from the private copy that was hashed, not
+                # from the original:
+                run('{python} {peep} install -r {reqs}',
+                    python=python_path(), peep=peep_path(), reqs=reqs_path)
+                run('pip uninstall -y treepkg')
+                ok_(not exists(join(tree, 'treepkg.egg-info')))
+
+                with open(join(tree, 'setup.py'), 'a') as file:
+                    file.write('# tampering\n')
+                try:
+                    run('{python} {peep} install -r {reqs}',
+                        python=python_path(), peep=peep_path(), reqs=reqs_path)
+                except CalledProcessError as exc:
+                    ok_(b"DIDN'T MATCH" in exc.output)
+                else:
+                    self.fail("peep install didn't notice a changed tree.")
+
+    def test_target_envs(self):
+        """Given several ``--target-env``s, peep should verify once and
+        install into each of them, leaving its own environment alone."""
+        with ephemeral_dir() as temp_dir:
+            targets = [join(temp_dir, 'one'), join(temp_dir, 'two')]
+            for target in targets:
+                make_virtualenv(target)
+            with running_setup_py(should_make_sure_did_not_upgrade=True):
+                with requirements("""# sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                                  useless==1.0""") as reqs_path:
+                    run('{python} {peep} install -r {reqs} --index-url {local} '
+                        '--target-env {one} --target-env={two}',
+                        python=python_path(), peep=peep_path(), reqs=reqs_path,
+                        local=self.index_url(), one=targets[0], two=targets[1])
+            check = 'import pkg_resources; pkg_resources.require("useless==1.0")'
+            for target in targets:
+                run('{python} -c {check}',
+                    python=join(target, 'bin', 'python'), check=check)
+            try:
+                run('{python} -c {check} 2>&1', python=python_path(), check=check)
+            except CalledProcessError:
+                pass
+            else:
+                self.fail('peep installed into its own environment, too.')
+
+    def test_target_env(self):
+        """``--target-env`` should install into the given environment and skip
+        requirements that environment already has."""
+        reqs = """# sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                  useless==1.0"""
+        install = '{python} {peep} install -r {reqs} --index-url {local} --target-env {target}'
+        with requirements(reqs) as reqs_path:
+            with running_setup_py(should_make_sure_did_not_upgrade=True):
+                run(install, python=python_path(), peep=peep_path(), reqs=reqs_path,
+                    local=self.index_url(), target=python_path())
+            with running_setup_py(False):
+                output = run(install, python=python_path(), peep=peep_path(),
+                             reqs=reqs_path, local=self.index_url(),
+                             target=python_path())
+            ok_(b'already installed' in output)
+        run('pip uninstall -y useless')
+
+    def test_lock(self):
+        """``peep lock`` should add hashes above requirements that lack them,
+        leaving the rest of the file alone."""
+        reqs = ('# The useless package\n'
+                'useless==1.0  # Really\n'
+                '\n'
+                '# sha256: Aa\n'
+                'https://example.com/schema.zip#egg=schema\n')
+        with requirements(reqs) as reqs_path:
+            run('{python} {peep} lock -r {reqs} --index-url {local}',
+                python=python_path(), peep=peep_path(), reqs=reqs_path,
+                local=self.index_url())
+            with open(reqs_path) as file:
+                eq_(file.read(),
+                    '# The useless package\n'
+                    '# sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10\n'
+                    'useless==1.0  # Really\n'
+                    '\n'
+                    '# sha256: Aa\n'
+                    'https://example.com/schema.zip#egg=schema\n')
+
+    def test_lock_all_artifacts(self):
+        """``peep lock --all-artifacts`` should pin every archive of each
+        version, like both the wheel and the sdist of useless 1.5, fetching
+        them during the parallel download pass."""
+        with requirements('useless==1.5\nuseless==2.0\n') as reqs_path:
+            run('{python} {peep} lock -r {reqs} --index-url {local} '
+                '--all-artifacts --jobs 2',
+                python=python_path(), peep=peep_path(), reqs=reqs_path,
+                local=self.index_url())
+            with open(reqs_path) as file:
+                lines = file.read().splitlines()
+        eq_(sorted(lines[:2]),
+            ['# sha256: TLTR61aO3ibC9oADESIIssaukIjuSiXr_GRYsmk0qdw',  # wheel
+             '# sha256: y6S3tzzfk6M911mYO_-BbKSeZX3hRrvkCiPuG_uk1_Q'])  # sdist
+        eq_(lines[2:],
+            ['useless==1.5',
+             '# sha256: r13L3--ud0d6Ubsvt2ys_TuwQRd1M-lnlkW3Xahrct8',
+             'useless==2.0'])
+
+    def test_upgrade_command(self):
+        """``peep upgrade`` should repin requirements to their newest versions
+        and swap in the new hashes, leaving the rest of the file alone."""
+        reqs = ('# The useless package\n'
+                '# sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10\n'
+                'useless==1.0  # Really\n'
+                '\n'
+                '# sha256: Aa\n'
+                'https://example.com/schema.zip#egg=schema\n')
+        with requirements(reqs) as reqs_path:
+            upgrade = '{python} {peep} upgrade -r {reqs} --index-url {local}'
+            output = run(upgrade + ' --only schema', python=python_path(),
+                         peep=peep_path(), reqs=reqs_path, local=self.index_url())
+            ok_('Everything is up to date.' in output.decode('ascii'))
+            output = run(upgrade, python=python_path(), peep=peep_path(),
+                         reqs=reqs_path, local=self.index_url())
+            ok_('Upgraded useless from 1.0 to 2.0.' in output.decode('ascii'))
+            with open(reqs_path) as file:
+                eq_(file.read(),
+                    '# The useless package\n'
+                    '# sha256: r13L3--ud0d6Ubsvt2ys_TuwQRd1M-lnlkW3Xahrct8\n'
+                    'useless==2.0  # Really\n'
+                    '\n'
+                    '# sha256: Aa\n'
+                    'https://example.com/schema.zip#egg=schema\n')
+
+    def test_check(self):
+        """``peep check`` should report structural problems without
+        downloading anything."""
+        reqs = ('# sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10\n'
+                'useless==1.0\n'
+                'nohash==1.0\n'
+                '# sha256: tooshort\n'
+                'badhash==1.0\n'
+                '# sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10\n'
+                'https://example.com/nameless.tar.gz\n'
+                '# sha256: Q7PVYWdV3NFZ3bkx5bNmUd74UTCe7jrwf2AeM4wUD1A\n'
+                'useless==1.0\n'
+                'hexhash==1.0 --hash=sha256:%s\n'
+                'badhex==1.0 --hash=sha256:abc\n' %
+                hex_hash('f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10'))
+        with requirements(reqs) as reqs_path:
+            try:
+                run('{python} {peep} check --json {reqs}',
+                    python=python_path(), peep=peep_path(), reqs=reqs_path)
+            except CalledProcessError as exc:
+                problems = json.loads(exc.output.decode('utf-8'))
+            else:
+                self.fail("peep check didn't fail on a bad file.")
+        eq_([(p['line'], p['problem']) for p in problems],
+            [(3, 'missing-hashes'),
+             (5, 'malformed-hash'),
+             (7, 'unknown-name'),
+             (9, 'conflicting-hashes'),
+             (11, 'malformed-hash')])
+
+    def test_check_missing_include(self):
+        """``peep check`` should report an include it can't read against the
+        line including it, and go on checking the rest of the file."""
+        with requirements('-r does-not-exist.txt\n'
+                          'nohash==1.0\n') as reqs_path:
+            try:
+                run('{python} {peep} check --json {reqs}',
+                    python=python_path(), peep=peep_path(), reqs=reqs_path)
+            except CalledProcessError as exc:
+                problems = json.loads(exc.output.decode('utf-8'))
+            else:
+                self.fail("peep check didn't fail on a missing include.")
+        eq_([(p['path'], p['line'], p['problem']) for p in problems],
+            [(reqs_path, 1, 'unreadable'),
+             (reqs_path, 2, 'missing-hashes')])
+
+    def test_audit(self):
+        """``peep audit`` should report requirements that aren't installed."""
+        with requirements('useless==1.0\n') as reqs_path:
+            try:
+                run('{python} {peep} audit -r {reqs} --cache {cache}',
+                    python=python_path(), peep=peep_path(), reqs=reqs_path,
+                    cache=reqs_path + '.audit')
+            except CalledProcessError as exc:
+                ok_(b'useless==1.0: not installed' in exc.output)
+            else:
+                self.fail("peep audit didn't fail on a missing requirement.")
+
+    def test_audit_files(self):
+        """``peep audit`` should report files modified, missing, or added since
+        they were installed and, on later runs, take files whose size and
+        mtime haven't changed on faith, unless told ``--full``."""
+        with ephemeral_dir() as site:
+            makedirs(join(site, 'tampered'))
+            makedirs(join(site, 'tampered-1.0.dist-info'))
+            contents = {'tampered/__init__.py': 'x = 0\n',
+                        'tampered/a.py': 'a = 1\n',
+                        'tampered/b.py': 'b = 2\n',
+                        'tampered-1.0.dist-info/METADATA':
+                            'Metadata-Version: 2.0\nName: tampered\nVersion: 1.0\n'}
+            record = []
+            for name, text in sorted(contents.items()):
+                with open(join(site, name), 'w') as file:
+                    file.write(text)
+                record.append('%s,sha256=%s,%s\n' % (
+                    name, hash_of_file(join(site, name)), len(text)))
+            record.append('tampered-1.0.dist-info/RECORD,,\n')
+            with open(join(site, 'tampered-1.0.dist-info', 'RECORD'), 'w') as file:
+                file.write(''.join(record))
+
+            def audit(*args):
+                try:
+                    run('PYTHONPATH={site} {python} {peep} audit --cache {cache} ' +
+                        ' '.join(args),
+                        site=site, python=python_path(), peep=peep_path(),
+                        cache=join(site, 'audit.json'))
+                except CalledProcessError as exc:
+                    return exc.output.decode('utf-8').splitlines()
+                self.fail("peep audit didn't notice the tampering.")
+
+            # Same size, but a stamped mtime we can put back later:
+            a_path = join(site, 'tampered', 'a.py')
+            with open(a_path, 'w') as file:
+                file.write('a = 3\n')
+            utime(a_path, (1000000000, 1000000000))
+            remove(join(site, 'tampered', 'b.py'))
+            with open(join(site, 'tampered', 'c.py'), 'w') as file:
+                file.write('c = 4\n')
+            problems = [line for line in audit() if line.startswith('tampered:')]
+            eq_(problems,
+                ['tampered: modified %s' % a_path,
+                 'tampered: missing %s' % join(site, 'tampered', 'b.py'),
+                 'tampered: unexpected %s' % join(site, 'tampered', 'c.py')])
+
+            # Put a.py back without changing its size or mtime. The remembered
+            # hash is trusted, so it still looks modified until --full:
+            with open(a_path, 'w') as file:
+                file.write('a = 1\n')
+            utime(a_path, (1000000000, 1000000000))
+            ok_('tampered: modified %s' % a_path in audit())
+            ok_('tampered: modified %s' % a_path not in audit('--full'))
+
+    def test_port(self):
+        """Test peep port."""
+        schema_package_name = 'https://github.com/erikrose/schema/archive/99dc4130f0f05fd3c2d4bc6663a2419851f3c90f.zip#egg=schema'
 
         reqs = """
             # sha256: Jo-gDCfedW1xZj3WH3OkqNhydWm7G0dLLOYCBVOCaHI
@@ -449,6 +1272,29 @@ class FullStackTests(ServerTestCase):
             ''.format(schema=schema_package_name, reqs_path=reqs_path))
         eq_(result, expected)
 
+    def test_port_in_place(self):
+        """``peep port --in-place`` should rewrite the file, keeping comments
+        and options."""
+        reqs = ('--index-url https://example.com/simple/\n'
+                '# A comment above hash\n'
+                '# sha256: mrHTE_mbIJ-PcaYp82gzAwyNfHIoLPd1aDS69WfcpmI\n'
+                '# A comment between hash and package\n'
+                'click==4.0  # inline\n'
+                '\n'
+                'configobj==5.0.6\n')
+        with requirements(reqs) as reqs_path:
+            run('{python} {peep} port --in-place {reqs}',
+                python=python_path(), peep=peep_path(), reqs=reqs_path)
+            with open(reqs_path) as file:
+                eq_(file.read(),
+                    '--index-url https://example.com/simple/\n'
+                    '# A comment above hash\n'
+                    '# A comment between hash and package\n'
+                    'click==4.0 \\\n'
+                    '    --hash=sha256:9ab1d313f99b209f8f71a629f36833030c8d7c72282cf7756834baf567dca662  # inline\n'
+                    '\n'
+                    'configobj==5.0.6\n')
+
 
 class HashParsingTests(ServerTestCase):
     """Tests for finding the hashes above each requirement"""
@@ -503,6 +1349,25 @@ class HashParsingTests(ServerTestCase):
         # mistaken for a hash:
         eq_(reqs[0].__class__, MissingReq)
 
+    def test_hash_options(self):
+        """pip 8's hex ``--hash`` options should come out in peep's format,
+        alongside any hash comments."""
+        try:
+            activate('pip>=8.0')
+        except RuntimeError:
+            raise SkipTest("pip can't parse --hash options until 8.0.")
+        reqs = self.downloaded_reqs("""
+            # sha256: abc
+            useless==1.0 --hash=sha256:%s
+            useless==1.0 \\
+                --hash=sha256:%s""" % (
+                hex_hash('t9XWiL3TRb-ol3d9KXdWaIzwLhs3QsVoheLlwrmW_4I'),
+                hex_hash('f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10')))
+        eq_(reqs[0]._expected_hashes(),
+            ['abc', 't9XWiL3TRb-ol3d9KXdWaIzwLhs3QsVoheLlwrmW_4I'])
+        eq_(reqs[1]._expected_hashes(),
+            ['f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10'])
+
     def test_whitespace_stripping(self):
         """Make sure trailing whitespace is stripped from hashes."""
         reqs = self.downloaded_reqs("""
@@ -512,6 +1377,197 @@ class HashParsingTests(ServerTestCase):
         eq_(reqs[0]._expected_hashes(), ['trailing_space_should_be_stripped'])
 
 
+class ApiTests(ServerTestCase):
+    """Tests for the in-process API"""
+
+    def test_verify(self):
+        """verify() should return a result per requirement, and it should work
+        more than once per process."""
+        with requirements("""
+                # sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                useless==1.0
+                useless==2.0""") as path:
+            for _ in range(2):
+                good, missing = verify([path], ['--index-url', self.index_url()])
+                eq_(good.kind, InstallableReq)
+                ok_(good.ok)
+                eq_(good.actual_hash, 'f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10')
+                eq_(good.expected_hashes, [good.actual_hash])
+                ok_('download' in good.timings)
+                eq_(good.path, path)
+
+                eq_(missing.kind, MissingReq)
+                ok_(not missing.ok)
+                ok_(missing.actual_hash)
+                ok_(missing.actual_hash in missing.message)
+
+    def test_keep_archives(self):
+        """verify() should leave archives around only when asked."""
+        with requirements("""# sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                          useless==1.0""") as path:
+            result, = verify([path], ['--index-url', self.index_url()])
+            ok_(not exists(result.archive_path))
+            result, = verify([path], ['--index-url', self.index_url()], keep_archives=True)
+            try:
+                ok_(isfile(result.archive_path))
+            finally:
+                rmtree(dirname(result.archive_path))
+
+    def test_file_url(self):
+        """A file:// archive should be copied privately and verified."""
+        archive = join(tests_dir(), 'packages', 'useless', 'useless-1.0.tar.gz')
+        with requirements("""# sha256: f_y0x5sQfR1nj8HXuHStXojp_ihntAG-clNT2MNxF10
+                          file://%s#egg=useless""" % archive) as path:
+            result, = verify([path], keep_archives=True)
+            try:
+                eq_(result.kind, InstallableReq)
+                ok_(result.archive_path != archive)
+                with open(result.archive_path, 'rb') as copied:
+                    with open(archive, 'rb') as original:
+                        eq_(copied.read(), original.read())
+            finally:
+                rmtree(dirname(result.archive_path))
+
+
+class RateLimitTests(TestCase):
+    """Tests for the download rate limiter"""
+
+    def test_rate(self):
+        """After an initial burst, bytes should come only as fast as the
+        limit."""
+        limit = RateLimit(100000)
+        start = time()
+        eq_(sum(len(chunk) for chunk in limit.throttle([b'x' * 50000] * 4)), 200000)
+        ok_(0.9 < time() - start < 3)
+
+
+class ProgressTests(TestCase):
+    """Tests for the display of download progress"""
+
+    class Stream(object):
+        """A stand-in for stdout which remembers what's written to it"""
+        def __init__(self, is_tty):
+            self.is_tty = is_tty
+            self.text = ''
+
+        def write(self, text):
+            self.text += text
+
+        def flush(self):
+            pass
+
+        def isatty(self):
+            return self.is_tty
+
+    def test_log_lines(self):
+        """Off a terminal, concurrent downloads should be summed up in plain
+        lines."""
+        stream = self.Stream(is_tty=False)
+        progress = Progress(stream, interval=0)
+        first, second = progress.start(2048), progress.start(2048)
+        progress.advance(first, 1024)
+        progress.advance(second, 1024)
+        progress.finish(first)
+        progress.finish(second)
+        lines = stream.text.splitlines()
+        eq_(len(lines), 2)
+        ok_(lines[-1].startswith('2 downloads: 2.0K of 4.0K (50%) at '))
+
+    def test_status_line(self):
+        """On a terminal, one status line should be redrawn in place and
+        erased at the end."""
+        stream = self.Stream(is_tty=True)
+        progress = Progress(stream, interval=0)
+        list(progress.track([b'x' * 1024] * 3, 0))
+        eq_(stream.text.count('\n'), 0)
+        eq_(stream.text.count('\r1 download: '), 3)
+        ok_(stream.text.endswith('\r'))
+
+
+class BundleTests(TestCase):
+    """Tests for writing and unpacking bundles"""
+
+    def round_trip(self, name):
+        """Bundle a small tree into a file called ``name``, unpack it, and
+        make sure everything, hash included, comes back out."""
+        with ephemeral_dir() as temp_dir:
+            root = join(temp_dir, 'root')
+            makedirs(join(root, 'lib'))
+            with open(join(root, 'lib', 'useful.py'), 'w') as file:
+                file.write('x = 1\n')
+            bundle = join(temp_dir, name)
+            hash = write_bundle(bundle, root, {'requirements': ['useful==1.0']})
+            eq_(hash, hash_of_file(bundle))
+
+            dest = join(temp_dir, 'dest')
+            makedirs(dest)
+            eq_(extract_bundle(bundle, dest), hash)
+            with open(join(dest, 'lib', 'useful.py')) as file:
+                eq_(file.read(), 'x = 1\n')
+            with open(join(dest, 'peep-bundle.json')) as file:
+                eq_(json.load(file), {'requirements': ['useful==1.0']})
+
+    def test_gzip(self):
+        self.round_trip('env.tar.gz')
+
+    def test_zstandard(self):
+        try:
+            import zstandard  # noqa
+        except ImportError:
+            raise SkipTest('The zstandard module is not installed.')
+        self.round_trip('env.tar.zst')
+
+
+class IsLocalTests(TestCase):
+    """Tests for which installed distributions ``peep sync`` may remove"""
+
+    def test_sibling_prefix(self):
+        """A dir next to ours whose name merely starts with our prefix
+        shouldn't count as ours."""
+        class Dist(object):
+            def __init__(self, location):
+                self.location = location
+        ok_(is_local(Dist(join(sys.prefix, 'lib', 'site-packages'))))
+        ok_(not is_local(Dist(sys.prefix + '-other')))
+        ok_(not is_local(Dist(join(sys.prefix + '-other', 'lib', 'site-packages'))))
+
+
+class TreeHashTests(TestCase):
+    """Tests for hashing directory trees"""
+
+    def test_canonical(self):
+        """Tree hashes should ignore VCS metadata and bytecode but notice
+        changes in executability."""
+        with ephemeral_dir() as root:
+            makedirs(join(root, 'pkg'))
+            with open(join(root, 'pkg', '__init__.py'), 'w') as file:
+                file.write('x = 1')
+            original = tree_hash(root)
+
+            makedirs(join(root, '.git'))
+            for path in [join(root, '.git', 'HEAD'), join(root, 'pkg', '__init__.pyc')]:
+                with open(path, 'w') as file:
+                    file.write('noise')
+            eq_(tree_hash(root), original)
+
+            chmod(join(root, 'pkg', '__init__.py'), 0o755)
+            ok_(tree_hash(root) != original)
+
+    def test_copy(self):
+        """Copying a tree should hash it the same, leaving out what's
+        ignored."""
+        with ephemeral_dir() as root:
+            source, dest = join(root, 'source'), join(root, 'dest')
+            makedirs(join(source, '.git'))
+            for path in [join(source, 'setup.py'), join(source, '.git', 'HEAD')]:
+                with open(path, 'w') as file:
+                    file.write('pass')
+            chmod(join(source, 'setup.py'), 0o755)
+            eq_(copy_tree_and_hash(source, dest), tree_hash(source))
+            eq_(tree_hash(dest), tree_hash(source))
+            ok_(not exists(join(dest, '.git')))
+
+
 @nottest
 def run_test_server():
     """Run an index server for testing manually against.